@@ -1,6 +1,10 @@
-from flask import Flask, render_template, redirect, url_for, session, request, flash
-from authlib.integrations.flask_client import OAuth
-from firebase_service import initialize_firebase, get_all_trips, add_trip, delete_trip
+from flask import Flask, render_template, redirect, url_for, session, request, flash, before_render_template, template_rendered
+from chat_history import load_history, append_history
+import instrumentation
+import tasks  # registers background job handlers
+import threading
+import hmac
+import time
 import os
 from dotenv import load_dotenv
 
@@ -9,22 +13,91 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'supersecretkey')
 
-# Firebase Setup
-firebase_app = initialize_firebase()
+# Firestore, Gemini, Calendar and OAuth clients are all created on first use,
+# and their SDKs imported then, so a cold start that only serves the login
+# page loads none of them (see bench_startup.py).
 
-# Initialize Gemini Client (New SDK)
-from google import genai
-client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+# Per-request timing (Server-Timing header, /metrics, slow-request log).
+# Registered first so it also covers the hooks below.
+@app.before_request
+def _start_trace():
+    instrumentation.start_request(request.endpoint)
+
+@app.after_request
+def _finish_trace(response):
+    return instrumentation.finish_request(response, request.method)
+
+@app.teardown_request
+def _drop_trace(exc):
+    instrumentation.abandon_request()
+
+def _template_started(sender, template, context, **extra):
+    trace = instrumentation.current_trace()
+    if trace is not None:
+        context['_render_started'] = time.perf_counter()
+
+def _template_rendered(sender, template, context, **extra):
+    started = context.get('_render_started')
+    if started is not None:
+        seconds = time.perf_counter() - started
+        instrumentation.record('render', seconds)
+        instrumentation.record(f'render.{template.name}', seconds)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_rendered, app)
+
+# Endpoints that never touch Firestore
+_NO_FIRESTORE_ENDPOINTS = {'index', 'login', 'authorize', 'logout', 'static', 'metrics_route'}
+
+@app.before_request
+def _init_firebase():
+    if request.endpoint not in _NO_FIRESTORE_ENDPOINTS:
+        from firebase_service import initialize_firebase
+        initialize_firebase()
+
+# Every route with a <trip_id> is only served to the trip's owner and the
+# people it is shared with (see check_trip_access; normally no extra read).
+# Routes still handle logged-out users themselves.
+_OWNER_ONLY_ENDPOINTS = {'remove_trip'}
+# Form/link routes answer a denial with a redirect home; the rest return JSON
+_PAGE_ENDPOINTS = {'trip_detail', 'remove_trip', 'add_item', 'toggle_item', 'update_note_route',
+                   'save_note_route', 'share_trip_route', 'add_category_route',
+                   'delete_category_route', 'add_reminder_route', 'delete_item'}
+
+@app.before_request
+def _check_trip_access():
+    trip_id = (request.view_args or {}).get('trip_id')
+    user = session.get('user')
+    if trip_id is None or not user:
+        return None
+    from firebase_service import check_trip_access
+    role = check_trip_access(trip_id, user.get('sub'), user.get('email'))
+    if role == 'owner' or (role == 'shared' and request.endpoint not in _OWNER_ONLY_ENDPOINTS):
+        return None
+    if request.endpoint in _PAGE_ENDPOINTS:
+        flash('Trip not found.' if role is None else 'Only the trip owner can do that.', 'danger')
+        return redirect(url_for('home'))
+    return {'error': 'Not found'}, 404
 
 # OAuth Setup
-oauth = OAuth(app)
-google = oauth.register(
-    name='google',
-    client_id=os.getenv('GOOGLE_CLIENT_ID'),
-    client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={'scope': 'openid email profile https://www.googleapis.com/auth/calendar.events'},
-)
+_google = None
+_oauth_lock = threading.Lock()
+
+def google_oauth():
+    global _google
+    if _google is None:
+        with _oauth_lock:
+            if _google is None:
+                from authlib.integrations.flask_client import OAuth
+                oauth = OAuth(app)
+                _google = oauth.register(
+                    name='google',
+                    client_id=os.getenv('GOOGLE_CLIENT_ID'),
+                    client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
+                    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+                    client_kwargs={'scope': 'openid email profile https://www.googleapis.com/auth/calendar.events'},
+                )
+    return _google
 
 @app.route('/')
 def index():
@@ -36,10 +109,11 @@ def index():
 @app.route('/login')
 def login():
     redirect_uri = url_for('authorize', _external=True)
-    return google.authorize_redirect(redirect_uri)
+    return google_oauth().authorize_redirect(redirect_uri)
 
 @app.route('/authorize')
 def authorize():
+    google = google_oauth()
     token = google.authorize_access_token()
     session['token'] = token
     resp = google.get('https://www.googleapis.com/oauth2/v3/userinfo')
@@ -58,8 +132,16 @@ def home():
     if not user:
         return redirect(url_for('index'))
     
+    from firebase_service import get_all_trips
     trips = get_all_trips(user.get('sub'), user.get('email'))
-    return render_template('home.html', user=user, trips=trips)
+    
+    etag = None
+    if not session.get('_flashes'):
+        from page_cache import make_etag
+        etag = make_etag('home', user, [(t['id'], t.get('name'), t.get('location'), t.get('is_owner')) for t in trips])
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+    return _cacheable(app.make_response(render_template('home.html', user=user, trips=trips)), etag)
 
 @app.route('/add_trip', methods=['POST'])
 def create_trip():
@@ -73,6 +155,7 @@ def create_trip():
     end_date = request.form.get('end_date')
     
     if name:
+        from firebase_service import add_trip
         add_trip(user.get('sub'), name, location, start_date=start_date, end_date=end_date)
     
     return redirect(url_for('home'))
@@ -83,7 +166,16 @@ def remove_trip(trip_id):
     if not user:
         return redirect(url_for('index'))
     
-    delete_trip(trip_id)
+    # Items and notes go in the same request (a few chunked batches), since a
+    # background job can't be relied on where the process is frozen after the
+    # response (Vercel). The job is only the retry for a cascade that failed.
+    from firebase_service import delete_trip
+    try:
+        delete_trip(trip_id)
+    except Exception as e:
+        print(f"Error deleting trip data, retrying in the background: {e}")
+        from jobs import enqueue
+        enqueue('trip.delete_data', {'trip_id': trip_id}, owner=user.get('sub'))
     return redirect(url_for('home'))
 
 @app.route('/trip/<trip_id>')
@@ -92,42 +184,123 @@ def trip_detail(trip_id):
     if not user:
         return redirect(url_for('index'))
     
-    from firebase_service import get_trip, get_packing_items
+    from firebase_service import get_trip, get_trip_page
+    from page_cache import get_fragment, set_fragment, make_etag
+    
+    # Private notes are only fetched up front when that tab is opened directly;
+    # otherwise the tab lazy-loads them from trip_notes_route.
+    include_notes = request.args.get('active_tab') == 'notes'
+    filter_user = request.args.get('filter_user')
     
+    # The trip is read first: its version says whether the rendered category
+    # sections are current, and items read after it are at least that new
+    # (see get_trip_page), so whatever is cached or ETagged under a version
+    # really shows that version.
     trip = get_trip(trip_id)
     if not trip:
         return redirect(url_for('home'))
-        
-    items = get_packing_items(trip_id)
-    
-    contributors = set()
-    for item in items:
-        if item.get('added_by_name'):
-            contributors.add(item.get('added_by_name'))
-    sorted_contributors = sorted(list(contributors))
-    
-    filter_user = request.args.get('filter_user')
-    if filter_user:
-        items = [i for i in items if i.get('added_by_name') == filter_user]
-    
+    version = trip.get('version', 0)
+    
+    # Pages showing private notes or a flash message aren't cacheable
+    etag = None
+    if not include_notes and not session.get('_flashes'):
+        etag = make_etag('trip', trip_id, version, user, request.full_path)
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+    
+    fragment = get_fragment(trip_id, filter_user, version)
+    page = None
+    if fragment is None or include_notes:
+        page = get_trip_page(trip_id, user.get('sub'), include_notes=include_notes, trip=trip,
+                             include_items=fragment is None)
+    if fragment is None:
+        fragment = _render_categories(trip_id, trip, page, filter_user)
+        set_fragment(trip_id, filter_user, version, fragment)
+    
+    private_note = page['private_note'] if page else None
+    notes_cursor = page['notes_cursor'] if page else None
+    
+    # Live updates only matter when someone else can edit the list
+    from trip_sync import SYNC_ENABLED
+    live_sync = SYNC_ENABLED and bool(trip.get('shared_with'))
+    
+    from markupsafe import Markup
+    response = app.make_response(render_template(
+        'trip_detail.html', user=user, trip=trip, categories_html=Markup(fragment['html']),
+        sorted_categories=fragment['sorted_categories'], contributors=fragment['contributors'],
+        active_filter=filter_user, private_note=private_note, notes_cursor=notes_cursor,
+        trip_version=version, live_sync=live_sync))
+    return _cacheable(response, etag)
+
+def _render_categories(trip_id, trip, page, filter_user):
+    """Renders the packing list's category sections: {'html', 'sorted_categories', 'contributors'}."""
     grouped_items = {}
-    for item in items:
-        cat = item.get('category', 'General')
-        if cat not in grouped_items:
-            grouped_items[cat] = []
-        grouped_items[cat].append(item)
-        
-    available_categories = trip.get('categories', [])
-    for cat in grouped_items.keys():
+    
+    # Small trips come back whole in the first page and render eagerly. Larger
+    # ones only get per-category counts; sections load via category_items_route.
+    lazy_items = page['next_cursor'] is not None
+    if lazy_items:
+        from firebase_service import get_item_category_counts
+        summary = get_item_category_counts(trip_id, filter_user, trip=trip)
+        sorted_contributors = summary['contributors']
+        category_counts = summary['counts']
+    else:
+        items = page['items']
+        
+        contributors = set()
+        for item in items:
+            if item.get('added_by_name'):
+                contributors.add(item.get('added_by_name'))
+        sorted_contributors = sorted(list(contributors))
+        
+        if filter_user:
+            items = [i for i in items if i.get('added_by_name') == filter_user]
+        
+        for item in items:
+            cat = item.get('category', 'General')
+            if cat not in grouped_items:
+                grouped_items[cat] = []
+            grouped_items[cat].append(item)
+        category_counts = {cat: len(cat_items) for cat, cat_items in grouped_items.items()}
+        
+    available_categories = list(trip.get('categories', []))
+    for cat in category_counts.keys():
         if cat not in available_categories:
             available_categories.append(cat)
             
     sorted_categories = sorted(available_categories)
     
-    from firebase_service import get_user_trip_note
-    private_note = get_user_trip_note(trip_id, user.get('sub'))
+    html = render_template('_trip_categories.html', trip={'id': trip_id}, grouped_items=grouped_items,
+                           category_counts=category_counts, lazy_items=lazy_items,
+                           sorted_categories=sorted_categories, active_filter=filter_user)
+    return {'html': html, 'sorted_categories': sorted_categories, 'contributors': sorted_contributors}
+
+def _not_modified(etag):
+    response = app.response_class(status=304)
+    return _cacheable(response, etag)
+
+def _cacheable(response, etag):
+    # The browser keeps the page but asks again (If-None-Match) on every view
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/trip/<trip_id>/category/<path:category>/items')
+def category_items_route(trip_id, category):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    filter_user = request.args.get('filter_user') or None
+    cursor = request.args.get('cursor') or None
+    page_size = request.args.get('page_size', type=int)
+    
+    from firebase_service import get_packing_items_page
+    page = get_packing_items_page(trip_id, page_size, start_after=cursor, category=category, added_by_name=filter_user)
     
-    return render_template('trip_detail.html', user=user, trip=trip, grouped_items=grouped_items, sorted_categories=sorted_categories, contributors=sorted_contributors, active_filter=filter_user, private_note=private_note)
+    html = render_template('_category_items.html', items=page['items'], trip={'id': trip_id}, active_filter=filter_user)
+    return {'items': page['items'], 'next_cursor': page['next_cursor'], 'html': html}
 
 @app.route('/trip/<trip_id>/add_item', methods=['POST'])
 def add_item(trip_id):
@@ -140,14 +313,16 @@ def add_item(trip_id):
     note = request.form.get('note')
     
     if text_block:
-        from firebase_service import add_packing_item
+        from firebase_service import add_packing_items
         added_by_email = user.get('email')
         added_by_name = user.get('name', added_by_email)
         
         items = [line.strip() for line in text_block.splitlines() if line.strip()]
         
-        for item_text in items:
-            add_packing_item(trip_id, item_text, category, added_by_email=added_by_email, added_by_name=added_by_name, note=note)
+        results = add_packing_items(trip_id, items, category, added_by_email=added_by_email, added_by_name=added_by_name, note=note)
+        failed = [r['text'] for r in results if not r['ok']]
+        if failed:
+            flash(f'Could not add {len(failed)} of {len(results)} items.', 'danger')
         
     filter_user = request.form.get('filter_user')
     return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user))
@@ -161,7 +336,7 @@ def toggle_item(item_id, trip_id):
     current_status = request.args.get('status') == 'True'
     
     from firebase_service import toggle_packing_item
-    toggle_packing_item(item_id, current_status)
+    toggle_packing_item(item_id, current_status, trip_id=trip_id)
     
     filter_user = request.args.get('filter_user')
     return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user))
@@ -175,11 +350,23 @@ def update_note_route(item_id, trip_id):
     new_note = request.form.get('note')
     
     from firebase_service import update_packing_item_note
-    update_packing_item_note(item_id, new_note)
+    update_packing_item_note(item_id, new_note, trip_id=trip_id)
     
     filter_user = request.form.get('filter_user')
     return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user))
 
+@app.route('/trip/<trip_id>/notes')
+def trip_notes_route(trip_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    cursor = request.args.get('cursor') or None
+    page_size = request.args.get('page_size', type=int)
+    
+    from firebase_service import get_user_trip_notes_page
+    return get_user_trip_notes_page(trip_id, user.get('sub'), page_size, start_after=cursor)
+
 @app.route('/trip/<trip_id>/save_note', methods=['POST'])
 def save_note_route(trip_id):
     user = session.get('user')
@@ -249,30 +436,44 @@ def add_reminder_route(trip_id):
     summary = request.form.get('summary')
     date_str = request.form.get('date') # datetime-local
     
-    # Fetch items to list unchecked ones
-    from firebase_service import get_packing_items
-    items = get_packing_items(trip_id)
-    user_email = user.get('email')
-    unchecked_items = [i.get('text') for i in items if not i.get('is_completed') and i.get('added_by_email') == user_email]
-    
-    description = f"Trip Reminder for {summary}\n\n"
-    if unchecked_items:
-        description += "Unchecked Items:\n" + "\n".join([f"- {item}" for item in unchecked_items])
-    else:
-        description += "All items packed!"
-        
-    description += "\n\nAccess your list here: https://travel-pack-six.vercel.app"
-    
+    reminder_job = None
     if summary and date_str:
-        from calendar_service import create_calendar_event
-        link = create_calendar_event(token, summary, description, date_str)
-        if link:
-            flash(f'Reminder sent to {user.get("email")}', 'success')
+        # Building the description and calling Calendar happen in the background
+        # where a worker can run them, otherwise right here (see jobs.enqueue)
+        from jobs import enqueue, get_job, SUCCEEDED, FAILED
+        countdown_days = min(request.form.get('countdown_days', 0, type=int) or 0, 14)
+        reminder_job = enqueue('calendar.trip_reminder', {
+            'token': token,
+            'trip_id': trip_id,
+            'email': user.get('email'),
+            'summary': summary,
+            'date': date_str,
+            'countdown_days': countdown_days,
+        }, owner=user.get('sub'))
+        status = (get_job(reminder_job) or {}).get('status')
+        if status == SUCCEEDED:
+            reminder_job = None
+            flash(f'Reminder added to Google Calendar for {user.get("email")}.', 'success')
+        elif status == FAILED:
+            reminder_job = None
+            flash('Could not add the reminder to Google Calendar.', 'danger')
         else:
-            flash('Failed to add reminder. Please check permissions.', 'danger')
+            flash(f'Adding reminder for {user.get("email")}...', 'info')
             
     filter_user = request.form.get('filter_user')
-    return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user))
+    return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user, reminder_job=reminder_job))
+
+@app.route('/jobs/<job_id>')
+def job_status_route(job_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    from jobs import get_job
+    job = get_job(job_id, owner=user.get('sub'))
+    if job is None:
+        return {'error': 'Not found'}, 404
+    return job
 
 @app.route('/item/<item_id>/delete/<trip_id>')
 def delete_item(item_id, trip_id):
@@ -281,11 +482,67 @@ def delete_item(item_id, trip_id):
         return redirect(url_for('index'))
         
     from firebase_service import delete_packing_item
-    delete_packing_item(item_id)
+    delete_packing_item(item_id, trip_id=trip_id)
     
     filter_user = request.args.get('filter_user')
     return redirect(url_for('trip_detail', trip_id=trip_id, filter_user=filter_user))
 
+def _metrics_denied():
+    """
+    Error response for /metrics and /internal/cache_stats unless the request
+    carries METRICS_TOKEN as a bearer token. Without a token configured they
+    don't exist at all.
+    """
+    token = os.getenv('METRICS_TOKEN')
+    if not token:
+        return {'error': 'Not found'}, 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return {'error': 'Unauthorized'}, 401
+    return None
+
+@app.route('/internal/cache_stats')
+def cache_stats_route():
+    denied = _metrics_denied()
+    if denied:
+        return denied
+        
+    from firebase_service import get_item_cache_stats, get_trips_cache_stats
+    from chat_service import get_chat_stats
+    from response_cache import get_response_cache_stats
+    from firebase_service import get_acl_cache_stats
+    from page_cache import get_fragment_cache_stats
+    from trip_sync import get_sync_stats
+    from jobs import get_job_stats
+    return {'items': get_item_cache_stats(), 'trips': get_trips_cache_stats(), 'acl': get_acl_cache_stats(),
+            'fragments': get_fragment_cache_stats(), 'chat': get_chat_stats(),
+            'chat_responses': get_response_cache_stats(), 'jobs': get_job_stats(), 'sync': get_sync_stats()}
+
+@app.route('/metrics')
+def metrics_route():
+    # Prometheus scrape endpoint, only served when METRICS_TOKEN is set
+    denied = _metrics_denied()
+    if denied:
+        return denied
+    from flask import Response
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def _chat_session_id(trip_id):
+    """
+    Short id tying this browser session to its server-side chat history.
+    History left in the cookie by older versions is moved over on first use
+    for this trip; other trips' leftovers are dropped so the cookie shrinks.
+    """
+    import uuid
+    sid = session.get('chat_sid')
+    if not sid:
+        sid = uuid.uuid4().hex
+        session['chat_sid'] = sid
+    for key in [k for k in session.keys() if k.startswith('chat_history_')]:
+        legacy = session.pop(key)
+        if legacy and key == f'chat_history_{trip_id}':
+            append_history(sid, trip_id, *legacy)
+    return sid
+
 @app.route('/trip/<trip_id>/chat', methods=['POST'])
 def chat_route(trip_id):
     user = session.get('user')
@@ -295,73 +552,176 @@ def chat_route(trip_id):
     data = request.get_json()
     message = data.get('message')
     
-    # Chat History Management
-    history_key = f'chat_history_{trip_id}'
-    history = session.get(history_key, [])
-    
-    # Add user message to history
-    history.append({'role': 'user', 'parts': [message]})
-    
-    # Keep history manageable (last 10 turns)
-    if len(history) > 20:
-        history = history[-20:]
+    # Chat History Management (server-side, see chat_history.py)
+    sid = _chat_session_id(trip_id)
+    history = load_history(sid, trip_id)
     
     from firebase_service import get_packing_items
+    from chat_service import build_chat_prompt, generate_chat_response, ChatBusyError, ChatTimeoutError
+    from response_cache import chat_cache_key, cached_chat_response
     items = get_packing_items(trip_id)
-    items_text = ", ".join([f"{i.get('text')} ({i.get('category')})" for i in items])
-    
-    # Construct prompt with context
-    system_instruction = f"""
-    You are a helpful travel assistant for a packing list app.
-    Current Packing List: {items_text}
-    
-    If the user wants to add items, suggest them.
-    If the user wants to remove items, use the 'delete' action.
-    
-    Return a valid JSON object (no markdown formatting) with these fields:
-    - reply: A friendly text response.
-    - actions: A list of objects.
-      - Add: {{ "type": "add", "item": "Name", "category": "Category", "note": "Optional reason" }}
-      - Delete: {{ "type": "delete", "item": "Name" }}
-    
-    If no items to add/modify, 'actions' should be empty.
-    Keep the reply concise.
-    """
-    
-    # For this simple implementation with the new SDK, we can pass history in contents 
-    # but strictly structured chat with system instruction is better.
-    # The new SDK supports system_instruction argument in models.generate_content? 
-    # Yes, typically via config or 'system_instruction' param if using 1.5/pro models.
-    # However, 'gemini-2.5-flash' might just take it as part of the prompt.
-    # Let's verify if we can pass history simply.
-    
-    # We will construct a "chat-like" prompt manually for simplicity and robustness with JSON mode
-    full_prompt = system_instruction + "\n\nChat History:\n"
-    for msg in history:
-        role = "User" if msg['role'] == 'user' else "Model"
-        content = msg['parts'][0]
-        full_prompt += f"{role}: {content}\n"
-        
-    full_prompt += f"User: {message}\nModel:"
+    full_prompt = build_chat_prompt(items, history + [{'role': 'user', 'parts': [message]}], message)
     
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=full_prompt
-        )
-        text = response.text.replace('```json', '').replace('```', '').strip()
-        import json
-        result = json.loads(text)
-        
-        # Add model response to history
-        history.append({'role': 'model', 'parts': [result.get('reply', '')]})
-        session[history_key] = history
+        # Identical questions about an identical list, in the same conversation, share one answer
+        result = cached_chat_response(chat_cache_key(trip_id, message, items, history),
+                                      lambda: generate_chat_response(full_prompt, trip_id=trip_id))
+        
+        # Record both turns once we have an answer
+        append_history(sid, trip_id, {'role': 'user', 'parts': [message]},
+                       {'role': 'model', 'parts': [result.get('reply', '')]})
         
         return result
+    except ChatBusyError:
+        return {'reply': "I'm helping a lot of travellers right now. Please try again in a moment.", 'actions': []}, 503
+    except ChatTimeoutError:
+        return {'reply': "That took too long to think about. Please try again.", 'actions': []}, 504
     except Exception as e:
         print(f"Gemini Error: {e}")
         return {'reply': "Sorry, I'm having trouble thinking right now.", 'actions': []}
 
+def _sse(event, data):
+    import json
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/trip/<trip_id>/chat/stream', methods=['POST'])
+def chat_stream_route(trip_id):
+    """
+    Server-Sent Events version of chat_route: 'reply' events carry reply text
+    as it is generated, then one 'done' event has the full reply and actions.
+    """
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    data = request.get_json()
+    message = data.get('message')
+    
+    sid = _chat_session_id(trip_id)
+    history = load_history(sid, trip_id)
+    user_turn = {'role': 'user', 'parts': [message]}
+    
+    from firebase_service import get_packing_items
+    from chat_service import build_chat_prompt, stream_generate, parse_chat_response, log_token_usage, ReplyStreamParser, ChatBusyError, ChatTimeoutError, ChatResponseError, CHAT_TIMEOUT
+    from response_cache import chat_cache_key, get_cached_response, begin_flight, finish_flight
+    items = get_packing_items(trip_id)
+    cache_key = chat_cache_key(trip_id, message, items, history)
+    
+    def replay(result):
+        append_history(sid, trip_id, user_turn, {'role': 'model', 'parts': [result.get('reply', '')]})
+        yield _sse('reply', {'text': result.get('reply', '')})
+        yield _sse('done', {'reply': result.get('reply', ''), 'actions': result.get('actions', [])})
+    
+    from flask import Response
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        return Response(replay(cached), mimetype='text/event-stream', headers=sse_headers)
+    
+    is_leader, flight = begin_flight(cache_key)
+    if not is_leader:
+        # Someone is already asking this exact question; share their answer
+        def follow():
+            try:
+                yield from replay(flight.result(timeout=CHAT_TIMEOUT))
+            except Exception as e:
+                print(f"Gemini Error: {e}")
+                yield _sse('error', {'reply': "Sorry, I'm having trouble thinking right now.", 'actions': []})
+        return Response(follow(), mimetype='text/event-stream', headers=sse_headers)
+    
+    full_prompt = build_chat_prompt(items, history + [user_turn], message)
+    log_token_usage(trip_id, full_prompt)
+    try:
+        chunks = stream_generate(full_prompt)
+    except ChatBusyError as e:
+        finish_flight(cache_key, error=e)
+        return {'reply': "I'm helping a lot of travellers right now. Please try again in a moment.", 'actions': []}, 503
+    
+    def events():
+        parser = ReplyStreamParser()
+        result = None
+        error = None
+        try:
+            for chunk in chunks:
+                text = parser.feed(chunk)
+                if text:
+                    yield _sse('reply', {'text': text})
+            try:
+                result = parse_chat_response(parser.buffer)
+            except ChatResponseError:
+                if not parser.done:
+                    raise
+                # The reply already streamed fine; keep it and drop the unparseable actions
+                result = {'reply': parser.text, 'actions': []}
+            append_history(sid, trip_id, user_turn, {'role': 'model', 'parts': [result.get('reply', '')]})
+            yield _sse('done', {'reply': result.get('reply', ''), 'actions': result.get('actions', [])})
+        except Exception as e:
+            error = e
+            print(f"Gemini Error: {e}")
+            yield _sse('error', {'reply': "Sorry, I'm having trouble thinking right now.", 'actions': []})
+        finally:
+            # Also runs if the client disconnects, so followers never wait forever
+            if result is None and error is None:
+                error = ChatTimeoutError()
+            finish_flight(cache_key, result=result, error=error)
+    
+    return Response(events(), mimetype='text/event-stream', headers=sse_headers)
+
+@app.route('/trip/<trip_id>/events')
+def trip_events_route(trip_id):
+    """
+    Server-Sent Events stream of changes to the trip's items, made by anyone,
+    as they happen (see trip_sync.py). 'item' events carry the change, the
+    item's category, whether it shows under filter_user and its rendered
+    HTML; 'version', 'stale' and 'deleted' are passed through.
+    """
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+    
+    from trip_sync import SYNC_ENABLED, subscribe
+    if not SYNC_ENABLED:
+        return {'error': 'Live updates are disabled'}, 404
+    filter_user = request.args.get('filter_user') or None
+    since_version = request.args.get('version', type=int)
+    
+    # Also None when this worker has no stream slot left; the page retries with backoff
+    subscription = subscribe(trip_id)
+    if subscription is None:
+        return {'error': 'Live updates unavailable'}, 503, {'Retry-After': '30'}
+    import instrumentation
+    instrumentation.long_lived()
+    
+    def events():
+        try:
+            for event in subscription.events(since_version):
+                if event is None:
+                    yield ': ping\n\n'
+                elif event['type'] == 'item':
+                    yield _sse('item', _sync_item_payload(trip_id, event, filter_user))
+                else:
+                    yield _sse(event['type'], {k: v for k, v in event.items() if k != 'type'})
+        finally:
+            subscription.close()
+    
+    from flask import Response, stream_with_context
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _sync_item_payload(trip_id, event, filter_user):
+    item = event['item']
+    visible = not filter_user or item.get('added_by_name') == filter_user
+    payload = {'change': event['change'], 'id': item['id'], 'category': item.get('category') or 'General',
+               'visible': visible}
+    if visible and event['change'] != 'removed':
+        # Rendered once per filter and shared by every viewer of the event
+        key = ('html', filter_user)
+        if key not in event:
+            event[key] = render_template('_item.html', item=item, trip={'id': trip_id}, active_filter=filter_user)
+        payload['html'] = event[key]
+    return payload
+
 @app.route('/trip/<trip_id>/chat/confirm', methods=['POST'])
 def chat_confirm_route(trip_id):
     user = session.get('user')
@@ -371,19 +731,109 @@ def chat_confirm_route(trip_id):
     data = request.get_json()
     actions = data.get('actions', [])
     
-    from firebase_service import add_packing_item, delete_packing_item_by_text
-    count = 0
-    for action in actions:
-        if action.get('type') == 'add':
-            add_packing_item(trip_id, action.get('item'), action.get('category', 'General'), 
-                           added_by_email=user.get('email'), added_by_name=user.get('name', 'AI Assistant'), 
-                           note=action.get('note'))
-            count += 1
-        elif action.get('type') == 'delete':
-            delete_packing_item_by_text(trip_id, action.get('item'))
-            count += 1
+    from firebase_service import apply_item_actions
+    # One read to resolve item names, one atomic write for every add/delete
+    results = apply_item_actions(trip_id, actions, added_by_email=user.get('email'),
+                                 added_by_name=user.get('name', 'AI Assistant'))
+    count = sum(1 for r in results if r['ok'])
             
-    return {'status': 'success', 'count': count}
+    return {'status': 'success', 'count': count, 'results': results}
+
+# JSON API: same mutations as the form routes above, but each returns only the
+# changed entity so trip_detail.html can patch the DOM instead of reloading.
+def _item_payload(trip_id, item, filter_user=None):
+    html = render_template('_item.html', item=item, trip={'id': trip_id}, active_filter=filter_user)
+    return {'item': item, 'html': html}
+
+@app.route('/api/trip/<trip_id>/items', methods=['POST'])
+def api_add_items(trip_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    data = request.get_json() or {}
+    items = [line.strip() for line in (data.get('text') or '').splitlines() if line.strip()]
+    if not items:
+        return {'error': 'No items given'}, 400
+    
+    from firebase_service import add_packing_items
+    added_by_email = user.get('email')
+    results = add_packing_items(trip_id, items, data.get('category') or 'General', added_by_email=added_by_email,
+                                added_by_name=user.get('name', added_by_email), note=data.get('note'))
+    
+    # Rendered from what was written rather than read back one by one
+    added = [_item_payload(trip_id, r.pop('item'), data.get('filter_user')) for r in results if r['ok']]
+    return {'results': results, 'items': added}
+
+@app.route('/api/trip/<trip_id>/items/<item_id>/toggle', methods=['POST'])
+def api_toggle_item(trip_id, item_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    data = request.get_json() or {}
+    
+    from firebase_service import toggle_packing_item
+    item = toggle_packing_item(item_id, bool(data.get('is_completed')), trip_id=trip_id)
+    if not item:
+        return {'error': 'Item not found'}, 404
+    return _item_payload(trip_id, item, data.get('filter_user'))
+
+@app.route('/api/trip/<trip_id>/items/<item_id>', methods=['PATCH'])
+def api_update_item_note(trip_id, item_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    data = request.get_json() or {}
+    
+    from firebase_service import update_packing_item_note, get_packing_item
+    # Unknown ids and items of other trips are a 404, not a failed write
+    item = get_packing_item(item_id, trip_id)
+    if not item:
+        return {'error': 'Item not found'}, 404
+    if not update_packing_item_note(item_id, data.get('note'), trip_id=trip_id):
+        return {'error': 'Could not update note'}, 500
+    item['note'] = data.get('note')
+    return _item_payload(trip_id, item, data.get('filter_user'))
+
+@app.route('/api/trip/<trip_id>/items/<item_id>', methods=['DELETE'])
+def api_delete_item(trip_id, item_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    from firebase_service import delete_packing_item
+    item = delete_packing_item(item_id, trip_id=trip_id)
+    if not item:
+        return {'error': 'Item not found'}, 404
+    return {'id': item_id, 'category': item.get('category', 'General'), 'deleted': True}
+
+@app.route('/api/trip/<trip_id>/categories', methods=['POST'])
+def api_add_category(trip_id):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    name = ((request.get_json() or {}).get('name') or '').strip()
+    if not name:
+        return {'error': 'Category name required'}, 400
+    
+    from firebase_service import add_category_to_trip
+    if not add_category_to_trip(trip_id, name):
+        return {'error': 'Could not add category'}, 500
+    return {'category': name}
+
+@app.route('/api/trip/<trip_id>/categories/<path:category_name>', methods=['DELETE'])
+def api_delete_category(trip_id, category_name):
+    user = session.get('user')
+    if not user:
+        return {'error': 'Unauthorized'}, 401
+        
+    from firebase_service import remove_category_from_trip
+    if not remove_category_from_trip(trip_id, category_name):
+        return {'error': 'Could not remove category'}, 500
+    return {'category': category_name, 'deleted': True}
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
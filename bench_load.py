@@ -0,0 +1,254 @@
+"""
+Load benchmark for the app's hot routes, run entirely in-process against the
+memory_firestore stand-in (with injected per-RPC latency) and a stubbed
+Gemini client. For each route it reports p50/p95/p99 latency and the mean
+number of Firestore round trips per request. Latencies cover successful
+responses only; requests shed with 503 (chat's capacity limit) are counted
+separately, and chat's limit is raised to --concurrency unless
+CHAT_MAX_CONCURRENCY is set.
+
+    python bench_load.py                        # defaults below
+    python bench_load.py --latency-ms 30 --items 500 --concurrency 16
+    python bench_load.py --routes home,trip --json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROUTES = ['home', 'trip', 'trip_revalidate', 'add_item', 'toggle', 'api_toggle', 'chat', 'chat_stream']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark hot routes against the in-memory Firestore backend.')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--latency-ms', type=float, default=20, help='injected latency per Firestore round trip')
+    parser.add_argument('--llm-latency-ms', type=float, default=300, help='stub Gemini response time')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--trips', type=int, default=3, help='trips owned per user')
+    parser.add_argument('--items', type=int, default=150, help='items per trip')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chat-messages', type=int, default=20,
+                        help='distinct chat messages; repeats exercise the response cache')
+    parser.add_argument('--routes', default=','.join(ROUTES), help=f"comma-separated subset of {', '.join(ROUTES)}")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    return parser.parse_args()
+
+
+def configure_env(args):
+    # Must happen before the app modules are imported
+    os.environ['FIRESTORE_BACKEND'] = args.backend
+    os.environ['FIRESTORE_LATENCY_MS'] = str(args.latency_ms)
+    os.environ.setdefault('FIRESTORE_SQLITE_PATH', 'bench_firestore.sqlite3')
+    os.environ['JOB_QUEUE_BACKEND'] = 'memory'
+    os.environ['CHAT_HISTORY_BACKEND'] = 'memory'
+    os.environ.setdefault('CHAT_CACHE_BACKEND', 'memory')
+    os.environ.setdefault('GEMINI_API_KEY', 'bench')
+    # Measure chat itself rather than its load shedding (see chat_service.py)
+    os.environ.setdefault('CHAT_MAX_CONCURRENCY', str(args.concurrency))
+
+
+class StubModels:
+    """Stands in for client.models: fixed-latency JSON replies, optionally streamed."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def _reply(self, contents):
+        return json.dumps({'reply': f'Stub answer ({len(contents)} prompt chars). Remember sunscreen!',
+                           'actions': [{'type': 'add', 'item': 'Sunscreen', 'category': 'Toiletries'}]})
+
+    def generate_content(self, model=None, contents='', config=None):
+        time.sleep(self.latency)
+        return type('Response', (), {'text': self._reply(contents), 'usage_metadata': None})()
+
+    def generate_content_stream(self, model=None, contents='', config=None):
+        text = self._reply(contents)
+        step = max(1, len(text) // 8)
+        for i in range(0, len(text), step):
+            time.sleep(self.latency / 8)
+            yield type('Chunk', (), {'text': text[i:i + step]})()
+
+
+def seed(fs, args, rng):
+    users = [{'sub': f'user{u}', 'email': f'user{u}@example.com', 'name': f'User {u}'} for u in range(args.users)]
+    categories = ['General', 'Clothing', 'Toiletries', 'Electronics', 'Documents']
+    trips = {}
+    for user in users:
+        for t in range(args.trips):
+            fs.add_trip(user['sub'], f"Trip {t}", 'Goa', start_date='2030-01-01', owner_email=user['email'])
+        owned = [trip['id'] for trip in fs.get_all_trips(user['sub'], user['email'])]
+        trips[user['sub']] = owned
+        for trip_id in owned:
+            fs.add_packing_items(trip_id, [{'text': f'Item {i}', 'category': rng.choice(categories)}
+                                           for i in range(args.items)],
+                                 added_by_email=user['email'], added_by_name=user['name'])
+    # Every user also sees one trip shared by the next user
+    for i, user in enumerate(users):
+        other = users[(i + 1) % len(users)]
+        if other is not user:
+            fs.share_trip(trips[other['sub']][0], user['email'])
+    item_ids = {trip_id: [item['id'] for item in fs.get_packing_items(trip_id)]
+                for owned in trips.values() for trip_id in owned}
+    return users, trips, item_ids
+
+
+def make_requests(args, users, trips, item_ids):
+    messages = [f'What else should I pack for day {i}?' for i in range(args.chat_messages)]
+
+    def pick(rng, user):
+        # A trip the session user owns (routes enforce trip access)
+        return rng.choice(trips[user['sub']])
+
+    def home(client, rng, user):
+        return client.get('/home')
+
+    def trip(client, rng, user):
+        trip_id = pick(rng, user)
+        return client.get(f'/trip/{trip_id}')
+
+    etags = {}
+
+    def trip_revalidate(client, rng, user):
+        # A browser re-visiting: conditional GET with the ETag it got last time
+        trip_id = pick(rng, user)
+        key = (id(client), trip_id)
+        headers = {'If-None-Match': etags[key]} if key in etags else {}
+        response = client.get(f'/trip/{trip_id}', headers=headers)
+        if response.headers.get('ETag'):
+            etags[key] = response.headers['ETag']
+        return response
+
+    def add_item(client, rng, user):
+        trip_id = pick(rng, user)
+        return client.post(f'/trip/{trip_id}/add_item', data={'text': f'Extra {rng.random():.6f}', 'category': 'General'})
+
+    def toggle(client, rng, user):
+        trip_id = pick(rng, user)
+        item_id = rng.choice(item_ids[trip_id])
+        return client.get(f'/item/{item_id}/toggle/{trip_id}?status={rng.choice(["True", "False"])}')
+
+    def api_toggle(client, rng, user):
+        trip_id = pick(rng, user)
+        item_id = rng.choice(item_ids[trip_id])
+        return client.post(f'/api/trip/{trip_id}/items/{item_id}/toggle', json={'is_completed': rng.random() < 0.5})
+
+    def chat(client, rng, user):
+        trip_id = pick(rng, user)
+        return client.post(f'/trip/{trip_id}/chat', json={'message': rng.choice(messages)})
+
+    def chat_stream(client, rng, user):
+        trip_id = pick(rng, user)
+        response = client.post(f'/trip/{trip_id}/chat/stream', json={'message': rng.choice(messages)})
+        response.get_data()  # drain the stream
+        return response
+
+    return {'home': home, 'trip': trip, 'trip_revalidate': trip_revalidate, 'add_item': add_item, 'toggle': toggle,
+            'api_toggle': api_toggle, 'chat': chat, 'chat_stream': chat_stream}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_route(app, db, users, request_fn, args, seed_value):
+    local = threading.local()
+    counter = itertools.count()
+
+    def one(_):
+        if not hasattr(local, 'client'):
+            n = next(counter)
+            local.rng = random.Random(seed_value * 1000 + n)
+            local.client = app.test_client()
+            local.user = users[n % len(users)]
+            with local.client.session_transaction() as s:
+                s['user'] = local.user
+                s['token'] = {'access_token': 'bench'}
+        start = time.perf_counter()
+        response = request_fn(local.client, local.rng, local.user)
+        return (time.perf_counter() - start) * 1000, response.status_code
+
+    db.reset_stats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    stats = db.stats()
+
+    # Rejections return fast and would drag the percentiles down
+    latencies = sorted(ms for ms, status in results if status < 400) or [0.0]
+    rejected = sum(1 for _, status in results if status == 503)
+    errors = sum(1 for _, status in results if status >= 500 and status != 503)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'rejected': rejected,
+        'throughput_rps': len(results) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.mean(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'round_trips_per_request': stats['round_trips'] / len(results),
+        'documents_read_per_request': stats['documents_read'] / len(results),
+        'calls': stats['calls'],
+    }
+
+
+def main():
+    args = parse_args()
+    configure_env(args)
+    routes = [r.strip() for r in args.routes.split(',') if r.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        raise SystemExit(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import firebase_service as fs
+    import chat_service
+    import app as app_module
+
+    fs.initialize_firebase()
+    db = fs.db
+    chat_service._client = type('StubClient', (), {'models': StubModels(args.llm_latency_ms / 1000)})()
+
+    rng = random.Random(args.seed)
+    latency, db.latency = db.latency, 0  # seed at full speed
+    users, trips, item_ids = seed(fs, args, rng)
+    db.latency = latency
+
+    request_fns = make_requests(args, users, trips, item_ids)
+    results = {}
+    for i, route in enumerate(routes):
+        results[route] = run_route(app_module.app, db, users, request_fns[route], args, args.seed + i)
+
+    if args.json:
+        print(json.dumps({'config': vars(args), 'results': results}, indent=2))
+        return
+
+    print(f"backend={args.backend} latency={args.latency_ms}ms llm={args.llm_latency_ms}ms users={args.users} "
+          f"trips/user={args.trips} items/trip={args.items} requests/route={args.requests} "
+          f"concurrency={args.concurrency}")
+    header = f"{'route':15} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'req/s':>8} {'RT/req':>7} {'reads/req':>9} {'5xx':>5} {'503':>5}"
+    print(header)
+    print('-' * len(header))
+    for route, r in results.items():
+        print(f"{route:15} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} {r['p99_ms']:8.1f} {r['max_ms']:8.1f} "
+              f"{r['throughput_rps']:8.1f} {r['round_trips_per_request']:7.2f} "
+              f"{r['documents_read_per_request']:9.1f} {r['errors']:5d} {r['rejected']:5d}")
+    print('latencies in ms over successful responses; RT = Firestore round trips; 503 = shed by capacity limits')
+
+
+if __name__ == '__main__':
+    main()
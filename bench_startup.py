@@ -0,0 +1,96 @@
+"""
+Cold-start benchmark. Reports the import cost of each module in a fresh
+interpreter (python -X importtime), then the time from a cold `import app`
+to the first response for the login page and for a Firestore-backed page,
+and which heavy SDKs each one loaded.
+
+    python bench_startup.py [--runs 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import json
+import os
+
+MODULES = [
+    'flask',
+    'authlib.integrations.flask_client',
+    'firebase_admin.firestore',
+    'google.genai',
+    'googleapiclient.discovery',
+    'cache',
+    'jobs',
+    'chat_history',
+    'response_cache',
+    'chat_service',
+    'calendar_service',
+    'firebase_service',
+    'app',
+]
+
+HEAVY_SDKS = ['firebase_admin', 'google.cloud.firestore', 'google.genai', 'googleapiclient', 'authlib']
+
+# Runs in a fresh interpreter: time import app + first request
+_COLD_START = r'''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+if len(sys.argv) > 2:
+    with client.session_transaction() as s:
+        s['user'] = {'sub': 'bench', 'email': 'bench@example.com', 'name': 'Bench'}
+client.get(sys.argv[1])
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (done - imported) * 1000,
+    'loaded': [m for m in json.loads(sys.argv[-1]) if m in sys.modules],
+}))
+'''
+
+
+def import_cost(module):
+    """Cumulative import time in ms for module in a fresh interpreter."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    for line in reversed(result.stderr.splitlines()):
+        # "import time:   self [us] | cumulative | imported package"
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+    return None
+
+
+def cold_start(path, logged_in=False):
+    args = [sys.executable, '-c', _COLD_START, path] + (['user'] if logged_in else []) + [json.dumps(HEAVY_SDKS)]
+    result = subprocess.run(args, capture_output=True, text=True)
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'no output')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report import and cold-start costs.')
+    parser.add_argument('--runs', type=int, default=5, help='runs per measurement (median is reported)')
+    args = parser.parse_args()
+    os.environ.setdefault('GEMINI_API_KEY', 'bench')
+
+    print(f"Import cost per module (median of {args.runs}, cumulative ms)")
+    for module in MODULES:
+        samples = [s for s in (import_cost(module) for _ in range(args.runs)) if s is not None]
+        cost = f"{statistics.median(samples):8.1f}" if samples else '     n/a'
+        print(f"  {module:36} {cost}")
+
+    print(f"\nCold start (median of {args.runs}, ms)")
+    for label, path, logged_in in [('login page', '/', False), ('home page', '/home', True)]:
+        runs = [cold_start(path, logged_in) for _ in range(args.runs)]
+        print(f"  {label:12} import app {statistics.median(r['import_ms'] for r in runs):7.1f}"
+              f"   first request {statistics.median(r['first_request_ms'] for r in runs):7.1f}"
+              f"   SDKs loaded: {', '.join(runs[-1]['loaded']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
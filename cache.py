@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache with LRU eviction and an optional TTL.
+    Keeps hit/miss counters so callers can expose them. on_evict(key, value) is
+    called (outside the lock) whenever an entry is removed, expired or evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evicted(self, entries):
+        if self.on_evict:
+            for key, value in entries:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        expired = []
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                expired.append((key, value))
+            self.misses += 1
+        self._evicted(expired)
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._evicted(evicted)
+
+    def update(self, key, func):
+        """
+        Replaces the cached value with func(value) (write-through), keeping its
+        expiry. func should return a new object so readers holding the old value
+        are unaffected. Returns False when the key is not cached.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False
+            self._data[key] = (func(entry[0]), entry[1])
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self._evicted([(key, entry[0])])
+        return entry[0]
+
+    def discard_where(self, predicate):
+        """Drops every entry for which predicate(key, value) is true."""
+        with self._lock:
+            stale = [(k, v) for k, (v, _) in self._data.items() if predicate(k, v)]
+            for k, _ in stale:
+                del self._data[k]
+        self._evicted(stale)
+        return len(stale)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            cleared = [(k, v) for k, (v, _) in self._data.items()]
+            self._data.clear()
+        self._evicted(cleared)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'hit_rate': (self.hits / total) if total else 0.0
+            }
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller
+    (the leader) does the work, later callers wait for and share its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def begin(self, key):
+        """
+        Returns (is_leader, future). The leader must call finish() when done;
+        followers just wait on future.result().
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return False, future
+            future = Future()
+            self._calls[key] = future
+            return True, future
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, timeout=None):
+        is_leader, future = self.begin(key)
+        if not is_leader:
+            return future.result(timeout=timeout)
+        try:
+            result = func()
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result=result)
+        return result
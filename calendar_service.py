@@ -1,48 +1,141 @@
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import threading
 import datetime
+import json
+import os
 import dateutil.parser
+from instrumentation import timed
 
-def create_calendar_event(token_info, summary, description, start_time_str):
+CALENDAR_TIMEZONE = 'Asia/Kolkata' # Hardcoded for now per user context (IST)
+CALENDAR_HTTP_TIMEOUT = float(os.getenv('CALENDAR_HTTP_TIMEOUT', '10'))
+# The Calendar batch endpoint takes at most 50 calls per request
+CALENDAR_BATCH_LIMIT = 50
+
+_discovery_lock = threading.Lock()
+_discovery_doc = None
+# httplib2.Http is not thread-safe, so each worker thread keeps its own
+# connection (and its keep-alive socket) for reuse across calls.
+_local = threading.local()
+
+# googleapiclient and the auth transports are imported inside the functions
+# that need them; they are slow to load and most requests never use them.
+
+
+def _calendar_discovery():
+    """
+    The Calendar v3 discovery document, parsed once per process. Uses the copy
+    bundled with googleapiclient; only fetched over the network if missing.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        with _discovery_lock:
+            if _discovery_doc is None:
+                from googleapiclient import discovery_cache
+                doc = discovery_cache.get_static_doc('calendar', 'v3')
+                if doc is None:
+                    _, content = _http().request('https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest')
+                    doc = content
+                _discovery_doc = json.loads(doc)
+    return _discovery_doc
+
+
+def _http():
+    http = getattr(_local, 'http', None)
+    if http is None:
+        import httplib2
+        http = _local.http = httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT)
+    return http
+
+
+def _credentials(token_info):
+    from google.oauth2.credentials import Credentials
+    # Flask-Authlib's token dict has 'access_token', 'token_type', 'expires_in', etc.
+    return Credentials(
+        token=token_info.get('access_token'),
+        refresh_token=token_info.get('refresh_token'),
+        token_uri=token_info.get('uri'),
+        client_id=token_info.get('client_id'), # Might not be in token dict, but access_token is usually enough for immediate calls
+        client_secret=token_info.get('client_secret'),
+        scopes=token_info.get('scope')
+    )
+
+
+def get_calendar_service(token_info):
+    """Calendar client for this user on the cached discovery doc and this thread's transport."""
+    from googleapiclient.discovery import build_from_document
+    import google_auth_httplib2
+    http = google_auth_httplib2.AuthorizedHttp(_credentials(token_info), http=_http())
+    return build_from_document(_calendar_discovery(), http=http)
+
+
+def build_event(summary, description, start_time):
+    """
+    start_time: datetime or ISO string (HTML datetime-local sends 'YYYY-MM-DDTHH:MM').
+    Events last one hour.
+    """
+    start_dt = dateutil.parser.parse(start_time) if isinstance(start_time, str) else start_time
+    end_dt = start_dt + datetime.timedelta(hours=1)
+    return {
+        'summary': summary,
+        'description': description,
+        'start': {
+            'dateTime': start_dt.isoformat(),
+            'timeZone': CALENDAR_TIMEZONE,
+        },
+        'end': {
+            'dateTime': end_dt.isoformat(),
+            'timeZone': CALENDAR_TIMEZONE,
+        },
+    }
+
+
+def countdown_times(trip_start_date, days, at_time):
     """
-    Creates an event.
-    token_info: dict from session['token']
-    start_time_str: ISO format string from HTML datetime-local input
+    (datetime, days_left) for one reminder per day over the `days` days before
+    trip_start_date, at the time of day of at_time (a datetime or ISO string).
+    Past times are skipped.
     """
+    if not trip_start_date or days <= 0:
+        return []
+    start = dateutil.parser.parse(trip_start_date) if isinstance(trip_start_date, str) else trip_start_date
+    at = dateutil.parser.parse(at_time) if isinstance(at_time, str) else at_time
+    now = datetime.datetime.now()
+    times = []
+    for before in range(days, 0, -1):
+        day = start.date() - datetime.timedelta(days=before)
+        when = datetime.datetime.combine(day, at.time())
+        if when > now:
+            times.append((when, before))
+    return times
+
+
+@timed('calendar')
+def create_calendar_events(token_info, events):
+    """
+    Creates several events through the Calendar batch endpoint (one HTTP
+    request per 50 events). events are bodies from build_event().
+    Returns the htmlLink for each event in order, or None where it failed.
+    """
+    links = [None] * len(events)
+    if not events:
+        return links
     try:
-        # Construct Credentials from the token info
-        # Flask-Authlib's token dict has 'access_token', 'token_type', 'expires_in', etc.
-        creds = Credentials(
-            token=token_info.get('access_token'),
-            refresh_token=token_info.get('refresh_token'),
-            token_uri=token_info.get('uri'),
-            client_id=token_info.get('client_id'), # Might not be in token dict, but access_token is usually enough for immediate calls
-            client_secret=token_info.get('client_secret'),
-            scopes=token_info.get('scope')
-        )
-        
-        service = build('calendar', 'v3', credentials=creds)
-
-        # Parse start time
-        # UI datetime-local sends 'YYYY-MM-DDTHH:MM'
-        start_dt = dateutil.parser.parse(start_time_str)
-        end_dt = start_dt + datetime.timedelta(hours=1)
-        
-        event = {
-            'summary': summary,
-            'description': description,
-            'start': {
-                'dateTime': start_dt.isoformat(),
-                'timeZone': 'Asia/Kolkata', # Hardcoded for now per user context (IST)
-            },
-            'end': {
-                'dateTime': end_dt.isoformat(),
-                'timeZone': 'Asia/Kolkata',
-            },
-        }
-
-        event_result = service.events().insert(calendarId='primary', body=event).execute()
-        return event_result.get('htmlLink')
+        service = get_calendar_service(token_info)
     except Exception as e:
-        print(f"Error creating calendar event: {e}")
-        return None
+        print(f"Error creating calendar events: {e}")
+        return links
+
+    def on_result(request_id, response, exception):
+        if exception is not None:
+            print(f"Error creating calendar event: {exception}")
+            return
+        links[int(request_id)] = response.get('htmlLink')
+
+    for start in range(0, len(events), CALENDAR_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=on_result)
+        for i, event in enumerate(events[start:start + CALENDAR_BATCH_LIMIT], start):
+            batch.add(service.events().insert(calendarId='primary', body=event), request_id=str(i))
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"Error creating calendar events: {e}")
+    return links
@@ -0,0 +1,147 @@
+from cache import TTLCache
+from collections import deque
+import threading
+import sqlite3
+import time
+import os
+
+# Chat turns live server-side; the session only carries a short conversation
+# id. CHAT_HISTORY_BACKEND is 'firestore' (default, works across workers and
+# serverless instances), 'sqlite' (one host) or 'memory' (one process, for
+# local runs; refused on Vercel where every request may land on a new
+# instance). Each (conversation, trip) keeps at most CHAT_HISTORY_MAX_TURNS turns.
+CHAT_HISTORY_BACKEND = os.getenv('CHAT_HISTORY_BACKEND', 'firestore').lower()
+CHAT_HISTORY_MAX_TURNS = int(os.getenv('CHAT_HISTORY_MAX_TURNS', '20'))
+CHAT_HISTORY_SESSIONS = int(os.getenv('CHAT_HISTORY_SESSIONS', '5000'))
+CHAT_HISTORY_TTL = float(os.getenv('CHAT_HISTORY_TTL', str(7 * 24 * 3600)))
+CHAT_HISTORY_PATH = os.getenv('CHAT_HISTORY_PATH', 'chat_history.sqlite3')
+
+
+class MemoryHistoryBackend:
+    """Per-worker LRU of ring buffers; history is lost on restart."""
+
+    def __init__(self, max_turns, max_conversations, ttl):
+        self.max_turns = max_turns
+        self._cache = TTLCache(maxsize=max_conversations, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def load(self, sid, trip_id):
+        with self._lock:
+            turns = self._cache.get((sid, trip_id))
+            return list(turns) if turns is not None else []
+
+    def append(self, sid, trip_id, turns):
+        with self._lock:
+            buffer = self._cache.get((sid, trip_id))
+            if buffer is None:
+                buffer = deque(maxlen=self.max_turns)
+            buffer.extend(turns)
+            # Re-set so the entry's TTL restarts with each turn
+            self._cache.set((sid, trip_id), buffer)
+
+
+class SQLiteHistoryBackend:
+    """Local on-disk store shared by the workers on one host."""
+
+    def __init__(self, path, max_turns, ttl):
+        self.path = path
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS chat_turns ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT NOT NULL, trip_id TEXT NOT NULL, '
+                'role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS chat_turns_conv ON chat_turns (sid, trip_id, seq)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def load(self, sid, trip_id):
+        cutoff = time.time() - self.ttl if self.ttl else 0
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                'SELECT role, content FROM chat_turns WHERE sid = ? AND trip_id = ? AND created_at > ? '
+                'ORDER BY seq DESC LIMIT ?',
+                (sid, trip_id, cutoff, self.max_turns)
+            ).fetchall()
+        return [{'role': role, 'parts': [content]} for role, content in reversed(rows)]
+
+    def append(self, sid, trip_id, turns):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                'INSERT INTO chat_turns (sid, trip_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)',
+                [(sid, trip_id, t['role'], t['parts'][0] or '', now) for t in turns]
+            )
+            # Ring buffer: drop everything older than the newest max_turns
+            conn.execute(
+                'DELETE FROM chat_turns WHERE sid = ? AND trip_id = ? AND seq NOT IN ('
+                'SELECT seq FROM chat_turns WHERE sid = ? AND trip_id = ? ORDER BY seq DESC LIMIT ?)',
+                (sid, trip_id, sid, trip_id, self.max_turns)
+            )
+
+
+class FirestoreHistoryBackend:
+    """
+    trips/{trip_id}/chat_history/{sid} documents holding the bounded turn list,
+    so history follows the conversation across workers and deploys.
+    """
+
+    def __init__(self, max_turns):
+        self.max_turns = max_turns
+
+    def _doc(self, sid, trip_id):
+        import firebase_service
+        if not firebase_service.db:
+            return None
+        return firebase_service.db.collection('trips').document(trip_id).collection('chat_history').document(sid)
+
+    def load(self, sid, trip_id):
+        doc_ref = self._doc(sid, trip_id)
+        if doc_ref is None:
+            return []
+        doc = doc_ref.get()
+        return (doc.to_dict() or {}).get('turns', []) if doc.exists else []
+
+    def append(self, sid, trip_id, turns):
+        doc_ref = self._doc(sid, trip_id)
+        if doc_ref is None:
+            return
+        history = self.load(sid, trip_id) + list(turns)
+        doc_ref.set({'turns': history[-self.max_turns:], 'updated_at': time.time()})
+
+
+def _make_backend():
+    backend = CHAT_HISTORY_BACKEND
+    if backend == 'memory' and os.getenv('VERCEL'):
+        print("CHAT_HISTORY_BACKEND 'memory' doesn't survive between serverless requests, using firestore.")
+        backend = 'firestore'
+    try:
+        if backend == 'sqlite':
+            return SQLiteHistoryBackend(CHAT_HISTORY_PATH, CHAT_HISTORY_MAX_TURNS, CHAT_HISTORY_TTL)
+        if backend == 'firestore':
+            return FirestoreHistoryBackend(CHAT_HISTORY_MAX_TURNS)
+    except Exception as e:
+        print(f"Error opening chat history backend '{backend}', using memory: {e}")
+    return MemoryHistoryBackend(CHAT_HISTORY_MAX_TURNS, CHAT_HISTORY_SESSIONS, CHAT_HISTORY_TTL)
+
+
+_backend = _make_backend()
+
+
+def load_history(sid, trip_id):
+    try:
+        return _backend.load(sid, trip_id)
+    except Exception as e:
+        print(f"Error loading chat history: {e}")
+        return []
+
+
+def append_history(sid, trip_id, *turns):
+    try:
+        _backend.append(sid, trip_id, turns)
+    except Exception as e:
+        print(f"Error saving chat history: {e}")
@@ -0,0 +1,525 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import threading
+import queue
+import copy
+import time
+import json
+import math
+import re
+import os
+from instrumentation import in_context, record, timed
+
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+# Chat calls run on their own bounded pool so a burst of slow LLM replies can't
+# tie up every request thread. Up to CHAT_MAX_CONCURRENCY calls run at once and
+# CHAT_MAX_QUEUE more may wait for the pool; beyond that callers are turned away
+# immediately. The request thread still blocks until its reply arrives, so
+# CHAT_MAX_CONCURRENCY + CHAT_MAX_QUEUE must stay below the worker's thread
+# count (see Procfile) or chat can still take every thread. A nonzero
+# CHAT_QUEUE_TIMEOUT makes callers wait that long for a slot, holding their
+# threads too, so it defaults to failing fast.
+CHAT_MAX_CONCURRENCY = int(os.getenv('CHAT_MAX_CONCURRENCY', '3'))
+CHAT_MAX_QUEUE = int(os.getenv('CHAT_MAX_QUEUE', '2'))
+CHAT_QUEUE_TIMEOUT = float(os.getenv('CHAT_QUEUE_TIMEOUT', '0'))
+CHAT_TIMEOUT = float(os.getenv('CHAT_TIMEOUT', '20'))
+
+# The Gemini SDK is slow to import, so the client is created on first use
+# rather than at import; pages that never chat never load it.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google import genai
+                # The HTTP timeout makes abandoned calls give their pool slot back instead of hanging on
+                _client = genai.Client(
+                    api_key=os.getenv('GEMINI_API_KEY'),
+                    http_options={'timeout': int(CHAT_TIMEOUT * 1000)}
+                )
+    return _client
+
+
+# Replies are schema-constrained JSON; 'reply' comes first so it can be streamed.
+# Plain dicts (validated by the SDK) so building them doesn't import it.
+CHAT_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'reply': {'type': 'STRING'},
+        'actions': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'type': {'type': 'STRING', 'enum': ['add', 'delete']},
+                    'item': {'type': 'STRING'},
+                    'category': {'type': 'STRING'},
+                    'note': {'type': 'STRING'},
+                },
+                'required': ['type', 'item'],
+                'property_ordering': ['type', 'item', 'category', 'note'],
+            },
+        },
+    },
+    'required': ['reply', 'actions'],
+    'property_ordering': ['reply', 'actions'],
+}
+CHAT_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': CHAT_RESPONSE_SCHEMA,
+}
+
+
+def _chat_config():
+    # The SDK normalizes schema dicts in place, so each call gets its own copy
+    return copy.deepcopy(CHAT_CONFIG)
+# Extra model calls allowed when a reply still fails validation after local repair
+CHAT_REPAIR_RETRIES = int(os.getenv('CHAT_REPAIR_RETRIES', '1'))
+
+_executor = ThreadPoolExecutor(max_workers=CHAT_MAX_CONCURRENCY, thread_name_prefix='chat')
+_slots = threading.BoundedSemaphore(CHAT_MAX_CONCURRENCY + CHAT_MAX_QUEUE)
+_stats_lock = threading.Lock()
+_stats = {'calls': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0, 'in_flight': 0,
+          'parse_failures': 0, 'repaired': 0, 'retries': 0, 'retry_successes': 0, 'dropped_actions': 0}
+
+
+class ChatBusyError(Exception):
+    """Every chat slot is taken; the caller should retry later."""
+
+
+class ChatTimeoutError(Exception):
+    """The model did not answer within CHAT_TIMEOUT."""
+
+
+class ChatResponseError(ValueError):
+    """The model's reply is not a valid chat response object."""
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def _release(_future):
+    _count('in_flight', -1)
+    _slots.release()
+
+
+def run_chat_call(func, *args, timeout=None, **kwargs):
+    """
+    Runs func on the chat pool and waits up to timeout (default CHAT_TIMEOUT).
+    Raises ChatBusyError when the pool and its queue are full, ChatTimeoutError
+    when the call overruns. The slot is only freed once func really returns.
+    """
+    waited = time.perf_counter()
+    if not _slots.acquire(timeout=CHAT_QUEUE_TIMEOUT):
+        _count('rejected')
+        raise ChatBusyError()
+    record('gemini.wait', time.perf_counter() - waited)
+
+    _count('calls')
+    _count('in_flight')
+    future = _executor.submit(in_context(timed('gemini')(func)), *args, **kwargs)
+    future.add_done_callback(_release)
+    try:
+        return future.result(timeout=timeout or CHAT_TIMEOUT)
+    except FuturesTimeoutError:
+        _count('timeouts')
+        raise ChatTimeoutError()
+    except Exception:
+        _count('errors')
+        raise
+
+
+def generate(prompt, timeout=None, config=None):
+    """Gemini generation through the bounded chat pool (structured JSON by default)."""
+    return run_chat_call(get_client().models.generate_content, model=GEMINI_MODEL, contents=prompt,
+                         config=config if config is not None else _chat_config(), timeout=timeout)
+
+
+def generate_chat_response(prompt, trip_id=None, timeout=None):
+    """
+    Asks the model and returns the validated {'reply', 'actions'} dict. A reply
+    that fails validation even after local repair is retried at most
+    CHAT_REPAIR_RETRIES times before ChatResponseError is raised.
+    """
+    attempt_prompt = prompt
+    for attempt in range(CHAT_REPAIR_RETRIES + 1):
+        if attempt:
+            _count('retries')
+        response = generate(attempt_prompt, timeout=timeout)
+        log_token_usage(trip_id, attempt_prompt, response)
+        try:
+            result = parse_chat_response(response.text)
+        except ChatResponseError as e:
+            error = e
+            attempt_prompt = (prompt + "\n\n(Your previous answer was not a valid JSON object with "
+                              "'reply' and 'actions'. Answer again with only that JSON object.)\nModel:")
+            continue
+        if attempt:
+            _count('retry_successes')
+        return result
+    raise error
+
+
+def stream_generate(prompt, timeout=None):
+    """
+    Streaming variant of generate(): returns an iterator of text chunks as the
+    model produces them. The slot is taken before returning, so ChatBusyError is
+    raised here rather than mid-stream; ChatTimeoutError is raised by the
+    iterator once the whole reply overruns timeout (default CHAT_TIMEOUT).
+    """
+    waited = time.perf_counter()
+    if not _slots.acquire(timeout=CHAT_QUEUE_TIMEOUT):
+        _count('rejected')
+        raise ChatBusyError()
+    record('gemini.wait', time.perf_counter() - waited)
+
+    _count('calls')
+    _count('in_flight')
+    chunks = queue.Queue()
+
+    @in_context
+    @timed('gemini')
+    def pump():
+        try:
+            for chunk in get_client().models.generate_content_stream(model=GEMINI_MODEL, contents=prompt, config=_chat_config()):
+                chunks.put(('chunk', chunk.text or ''))
+            chunks.put(('done', None))
+        except Exception as e:
+            chunks.put(('error', e))
+
+    future = _executor.submit(pump)
+    future.add_done_callback(_release)
+    deadline = time.monotonic() + (timeout or CHAT_TIMEOUT)
+
+    def iterate():
+        while True:
+            try:
+                kind, value = chunks.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                _count('timeouts')
+                raise ChatTimeoutError()
+            if kind == 'chunk':
+                yield value
+            elif kind == 'done':
+                return
+            else:
+                _count('errors')
+                raise value
+
+    return iterate()
+
+
+# Prompt budget. Token counts are estimated at ~4 characters per token, which
+# is close enough for English item names to keep prompts bounded.
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv('CHAT_PROMPT_TOKEN_BUDGET', '2000'))
+CHAT_ITEMS_BUDGET_SHARE = 0.5
+CHAT_HISTORY_BUDGET_SHARE = 0.35
+CHAT_RELEVANT_ITEMS = int(os.getenv('CHAT_RELEVANT_ITEMS', '40'))
+CHAT_LOG_TOKENS = os.getenv('CHAT_LOG_TOKENS', '1').lower() in ('1', 'true', 'yes')
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def _terms(text):
+    # Lowercased words with a naive plural strip so "socks" matches "sock"
+    terms = []
+    for word in _WORD_RE.findall((text or '').lower()):
+        if len(word) > 3 and word.endswith('s'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class ItemIndex:
+    """
+    Tiny inverted index over a trip's items (text, category and note) used to
+    pick the items most relevant to a chat message with IDF-weighted overlap.
+    """
+
+    # Matches on the item name count more than matches on its category or note
+    FIELD_WEIGHTS = (('text', 1.0), ('category', 0.3), ('note', 0.3))
+
+    def __init__(self, items):
+        self.items = items
+        self.postings = {}
+        for pos, item in enumerate(items):
+            weights = {}
+            for field, weight in self.FIELD_WEIGHTS:
+                for term in _terms(item.get(field)):
+                    weights[term] = max(weights.get(term, 0.0), weight)
+            for term, weight in weights.items():
+                self.postings.setdefault(term, []).append((pos, weight))
+
+    def search(self, query, limit):
+        scores = {}
+        total = len(self.items) or 1
+        for term in set(_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for pos, weight in postings:
+                scores[pos] = scores.get(pos, 0.0) + idf * weight
+        ranked = sorted(scores, key=lambda pos: (-scores[pos], pos))
+        return [self.items[pos] for pos in ranked[:limit]]
+
+
+def _item_line(item):
+    return f"{item.get('text')} ({item.get('category')})"
+
+
+def _items_section(items, message, budget):
+    full = ", ".join(_item_line(i) for i in items)
+    if estimate_tokens(full) <= budget:
+        return f"Current Packing List: {full}"
+
+    # Too long: per-category counts, then the items that best match the message
+    counts = {}
+    for item in items:
+        cat = item.get('category') or 'General'
+        counts[cat] = counts.get(cat, 0) + 1
+    summary = ", ".join(f"{cat}: {n}" for cat, n in sorted(counts.items()))
+    section = f"Packing List Overview ({len(items)} items by category): {summary}\nItems relevant to this message:"
+    remaining = budget - estimate_tokens(section)
+    picked = []
+    for item in ItemIndex(items).search(message, limit=CHAT_RELEVANT_ITEMS):
+        line = _item_line(item)
+        cost = estimate_tokens(line) + 1
+        if cost > remaining:
+            break
+        picked.append(line)
+        remaining -= cost
+    return section + " " + (", ".join(picked) if picked else "(none matched)")
+
+
+def _history_section(history, budget):
+    lines = []
+    for msg in history:
+        role = "User" if msg['role'] == 'user' else "Model"
+        lines.append(f"{role}: {msg['parts'][0]}")
+
+    if sum(estimate_tokens(line) + 1 for line in lines) <= budget:
+        return "\n".join(lines)
+
+    # Over budget: keep the newest turns verbatim in 3/4 of it, summarize the rest
+    verbatim_budget = int(budget * 0.75)
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        cost = estimate_tokens(line) + 1
+        if used + cost > verbatim_budget:
+            break
+        kept.append(line)
+        used += cost
+    kept.reverse()
+    older = lines[:len(lines) - len(kept)]
+
+    # Older turns collapse into a one-line extractive summary of what the user asked
+    asks = [line[len("User: "):][:60] for line in older if line.startswith("User: ")]
+    summary = "Earlier in this chat the user asked about: " + "; ".join(asks)
+    room = max(0, budget - used) * 4
+    if len(summary) > room:
+        summary = summary[:room]
+    return "\n".join(([summary] if summary else []) + kept)
+
+
+def build_chat_prompt(items, history, message, budget=None):
+    """
+    Packing-list assistant prompt from the trip's items and the chat history,
+    kept within roughly budget tokens (CHAT_PROMPT_TOKEN_BUDGET). Large lists
+    are compressed to category counts plus the items relevant to message, and
+    older history turns are summarized.
+    """
+    budget = budget or CHAT_PROMPT_TOKEN_BUDGET
+    # The current message is sent on its own line below, not as history
+    if history and history[-1]['role'] == 'user' and history[-1]['parts'][0] == message:
+        history = history[:-1]
+
+    items_text = _items_section(items, message, int(budget * CHAT_ITEMS_BUDGET_SHARE))
+    
+    # Construct prompt with context
+    system_instruction = f"""
+    You are a helpful travel assistant for a packing list app.
+    {items_text}
+    
+    If the user wants to add items, suggest them.
+    If the user wants to remove items, use the 'delete' action.
+    
+    Return a valid JSON object (no markdown formatting) with these fields:
+    - reply: A friendly text response.
+    - actions: A list of objects.
+      - Add: {{ "type": "add", "item": "Name", "category": "Category", "note": "Optional reason" }}
+      - Delete: {{ "type": "delete", "item": "Name" }}
+    
+    If no items to add/modify, 'actions' should be empty.
+    Keep the reply concise.
+    """
+    
+    # We construct a "chat-like" prompt manually for simplicity and robustness with JSON mode
+    full_prompt = system_instruction + "\n\nChat History:\n"
+    history_text = _history_section(history, int(budget * CHAT_HISTORY_BUDGET_SHARE))
+    if history_text:
+        full_prompt += history_text + "\n"
+        
+    full_prompt += f"User: {message}\nModel:"
+    return full_prompt
+
+
+def log_token_usage(trip_id, prompt, response=None):
+    """Logs estimated prompt tokens and, when the SDK reports them, actual usage."""
+    if not CHAT_LOG_TOKENS:
+        return
+    line = f"Chat tokens trip={trip_id} prompt_est={estimate_tokens(prompt)}"
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        line += f" prompt={usage.prompt_token_count} output={usage.candidates_token_count} total={usage.total_token_count}"
+    print(line)
+
+
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+
+def _repair_json(text):
+    """Cheap local fixes for near-miss JSON: fences, surrounding prose, trailing commas."""
+    text = text.replace('```json', '').replace('```', '').strip()
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return _TRAILING_COMMA_RE.sub(r'\1', text)
+
+
+def _validate_chat_response(data):
+    if not isinstance(data, dict) or not isinstance(data.get('reply'), str):
+        raise ChatResponseError("response must be an object with a string 'reply'")
+    actions = data.get('actions') or []
+    if not isinstance(actions, list):
+        raise ChatResponseError("'actions' must be a list")
+
+    valid = []
+    for action in actions:
+        if (not isinstance(action, dict) or action.get('type') not in ('add', 'delete')
+                or not isinstance(action.get('item'), str) or not action['item'].strip()):
+            _count('dropped_actions')
+            continue
+        clean = {'type': action['type'], 'item': action['item'].strip()}
+        if action['type'] == 'add':
+            clean['category'] = (action.get('category') or 'General').strip() or 'General'
+            if action.get('note'):
+                clean['note'] = str(action['note'])
+        valid.append(clean)
+    return {'reply': data['reply'], 'actions': valid}
+
+
+def parse_chat_response(text):
+    """
+    Parses and validates a chat reply. Structured output normally parses on the
+    first try; otherwise one local repair pass is attempted before giving up
+    with ChatResponseError.
+    """
+    try:
+        return _validate_chat_response(json.loads(text or ''))
+    except (ValueError, TypeError):
+        _count('parse_failures')
+    try:
+        result = _validate_chat_response(json.loads(_repair_json(text or '')))
+    except (ValueError, TypeError) as e:
+        raise ChatResponseError(str(e))
+    _count('repaired')
+    return result
+
+
+class ReplyStreamParser:
+    """
+    Incrementally pulls the "reply" string out of a JSON object that is still
+    being generated, so reply text can be shown before the JSON is complete.
+    feed() returns the newly decoded reply text (possibly empty).
+    """
+
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.buffer = ''
+        self.text = ''  # reply decoded so far
+        self.pos = None  # index of the next undecoded reply character
+        self.done = False
+
+    def _find_start(self):
+        key = self.buffer.find('"reply"')
+        if key == -1:
+            return
+        i = key + len('"reply"')
+        while i < len(self.buffer) and self.buffer[i] in ' \t\r\n:':
+            i += 1
+        if i < len(self.buffer) and self.buffer[i] == '"':
+            self.pos = i + 1
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.done:
+            return ''
+        if self.pos is None:
+            self._find_start()
+            if self.pos is None:
+                return ''
+
+        out = []
+        buf = self.buffer
+        i = self.pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch != '\\':
+                out.append(ch)
+                i += 1
+                continue
+            # Escape sequence: wait for the rest of it if the chunk split it
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc == 'u':
+                if i + 6 > len(buf):
+                    break
+                try:
+                    code = int(buf[i + 2:i + 6], 16)
+                except ValueError:
+                    code = 0xFFFD
+                if 0xD800 <= code < 0xDC00:
+                    # High surrogate: decode together with the low half that follows
+                    if i + 12 > len(buf):
+                        break
+                    try:
+                        low = int(buf[i + 8:i + 12], 16)
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                        i += 6
+                    except ValueError:
+                        code = 0xFFFD
+                out.append(chr(code))
+                i += 6
+            else:
+                out.append(self._ESCAPES.get(esc, esc))
+                i += 2
+        self.pos = i
+        text = ''.join(out)
+        self.text += text
+        return text
+
+
+def get_chat_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['max_concurrency'] = CHAT_MAX_CONCURRENCY
+    stats['max_queue'] = CHAT_MAX_QUEUE
+    return stats
@@ -0,0 +1,32 @@
+"""
+Removes packing items, private notes and chat history left behind by trips
+that no longer exist (trips deleted before deletion cascaded).
+
+    python compact_orphans.py --dry-run   # report only
+    python compact_orphans.py             # report and delete
+"""
+import argparse
+from dotenv import load_dotenv
+import firebase_service
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true', help='report orphans without deleting them')
+    args = parser.parse_args()
+
+    load_dotenv()
+    firebase_service.initialize_firebase()
+    if not firebase_service.db:
+        raise SystemExit('Firestore is not configured.')
+
+    report = firebase_service.compact_orphans(dry_run=args.dry_run)
+    verb = 'Would delete' if args.dry_run else 'Deleted'
+    print(f"Orphaned trips: {report['orphan_trips']}")
+    for name, stats in sorted(report['collections'].items()):
+        print(f"  {name}: {stats['documents']} documents, ~{stats['bytes'] / 1024:.1f} KiB")
+    print(f"{verb} {report['documents']} documents, ~{report['bytes'] / 1024:.1f} KiB reclaimed")
+
+
+if __name__ == '__main__':
+    main()
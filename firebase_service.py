@@ -1,14 +1,123 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core import exceptions as api_exceptions
+from cache import TTLCache
+from page_cache import invalidate_trip_fragments
+from instrumentation import ContextThreadPoolExecutor, instrument_module, instrument_firestore
+import threading
+import time
+from datetime import datetime, timezone, timedelta
 import os
 
 db = None
 
+# Firestore rejects batches with more than 500 writes
+BATCH_LIMIT = 500
+
+# Shared pool for fanning out independent Firestore calls (tasks keep the
+# caller's request trace, see instrumentation.py)
+_pool = ContextThreadPoolExecutor(max_workers=int(os.getenv('FIRESTORE_MAX_WORKERS', '8')))
+
+# Merged owned + shared trip lists per (user_id, email), used by /home
+_trips_cache = TTLCache(maxsize=1024, ttl=float(os.getenv('TRIPS_CACHE_TTL', '30')))
+
+# Page sizes for item reads; trips at or under EAGER_ITEMS_LIMIT render in full
+ITEMS_PAGE_SIZE = int(os.getenv('ITEMS_PAGE_SIZE', '50'))
+EAGER_ITEMS_LIMIT = int(os.getenv('EAGER_ITEMS_LIMIT', '200'))
+
+# Whether the (trip_id, created_at) composite index exists; None until probed.
+# A missing index is re-checked after ITEMS_INDEX_RECHECK seconds, since it may
+# just have been building.
+_items_index_available = None
+_items_index_checked_at = 0.0
+ITEMS_INDEX_RECHECK = float(os.getenv('ITEMS_INDEX_RECHECK', '600'))
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+# trips/{id}.version goes up with every change to the trip or its items, in
+# the same write as the change. Pages are cached and ETagged by it (see
+# page_cache.py), so every mutator below must bump it.
+def _bump_version(updates=None, current=None):
+    """
+    Adds the version bump to a trip update. Transactions that read the trip
+    pass its current version, so the new one is written (and known) exactly;
+    otherwise it is an Increment, see _committed_version.
+    """
+    updates = dict(updates or {})
+    updates['version'] = current + 1 if current is not None else firestore.Increment(1)
+    return updates
+
+def _committed_version(write_result):
+    """
+    The version a committed _bump_version update left the trip at, or None.
+    Firestore returns field transform results in field path order, and
+    'version' sorts after the trip's other transformed fields (categories,
+    summary.*), so it is the last one.
+    """
+    try:
+        value = list(write_result.transform_results)[-1]
+    except Exception:
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value.integer_value) if 'integer_value' in value else None
+    except Exception:
+        return None
+
+def _read_with_trip(transaction, item_ref, trip_id):
+    """
+    The item's snapshot and, when trip_id is known, the trip's current version,
+    in one transactional read. The version is None when it wasn't read.
+    """
+    if not trip_id:
+        return item_ref.get(transaction=transaction), None
+    trip_ref = db.collection('trips').document(trip_id)
+    snapshots = {snap.reference.path: snap for snap in transaction.get_all([item_ref, trip_ref])}
+    trip = snapshots.get(trip_ref.path)
+    version = (trip.to_dict() or {}).get('version', 0) if trip is not None and trip.exists else None
+    return snapshots[item_ref.path], version
+
+def _trip_changed(trip_id):
+    # Drop this worker's rendered copies right away rather than on the next version check
+    if trip_id:
+        invalidate_trip_fragments(trip_id)
+
 import json
 
+_init_lock = threading.Lock()
+_init_result = None
+
 def initialize_firebase():
+    """
+    Connects to Firestore once per process; later calls return the first
+    result. Called on first use (see app.py) rather than at import so cold
+    starts that only serve the login page skip it.
+    """
+    global _init_result
+    if _init_result is not None:
+        return _init_result
+    with _init_lock:
+        if _init_result is None:
+            _init_result = _connect_firebase()
+            if _init_result:
+                instrument_firestore(db)
+    return _init_result
+
+def _connect_firebase():
     global db
     try:
+        # 0. In-process stand-in for offline runs and benchmarks (see memory_firestore.py)
+        backend = os.getenv('FIRESTORE_BACKEND', 'firestore').lower()
+        if backend in ('memory', 'sqlite'):
+            import memory_firestore
+            db = memory_firestore.Client.from_env(backend)
+            print(f"Firebase replaced by the in-process '{backend}' backend.")
+            return True
+
         # 1. Check for environment variable (Production)
         firebase_creds = os.getenv('FIREBASE_CREDENTIALS')
         if firebase_creds:
@@ -34,35 +143,153 @@ def initialize_firebase():
         print(f"Error initializing Firebase: {e}")
         return False
 
+def _index_missing(e):
+    # Firestore answers a query that needs an undeclared index with FailedPrecondition
+    return isinstance(e, api_exceptions.FailedPrecondition)
+
+def _mark_items_index(available):
+    global _items_index_available, _items_index_checked_at
+    _items_index_available = available
+    _items_index_checked_at = time.monotonic()
+
+def _probe_items_index():
+    """
+    Checks (on the first items read, and again ITEMS_INDEX_RECHECK after finding
+    it missing) whether the ordered packing_items query is servable, so
+    get_packing_items doesn't pay a failed query on every load without it.
+    Other errors (timeouts, outages) say nothing about the index and are
+    retried on the next read.
+    """
+    try:
+        query = db.collection('packing_items').where('trip_id', '==', '').order_by('created_at', direction=firestore.Query.ASCENDING).limit(1)
+        list(query.stream())
+        _mark_items_index(True)
+        return True
+    except Exception as e:
+        if _index_missing(e):
+            print(f"packing_items (trip_id, created_at) index unavailable, sorting in memory: {e}")
+            _mark_items_index(False)
+        else:
+            print(f"Error probing packing_items index, will retry: {e}")
+        return False
+
+def _has_items_index():
+    if _items_index_available is None:
+        return _probe_items_index()
+    if not _items_index_available and time.monotonic() - _items_index_checked_at >= ITEMS_INDEX_RECHECK:
+        return _probe_items_index()
+    return _items_index_available
+
 def get_all_trips(user_id, user_email=None):
     if not db:
         return []
+    cache_key = (user_id, user_email)
+    cached = _trips_cache.get(cache_key)
+    if cached is not None:
+        return [dict(t) for t in cached]
     try:
         trips_ref = db.collection('trips')
         
-        # 1. Fetch owned trips
-        owned_query = trips_ref.where('user_id', '==', user_id).stream()
+        # Owned and shared queries are independent, so run them side by side
+        owned_future = _pool.submit(lambda: list(trips_ref.where('user_id', '==', user_id).stream()))
+        shared_future = None
+        if user_email:
+            shared_future = _pool.submit(lambda: list(trips_ref.where('shared_with', 'array_contains', user_email).stream()))
         
+        # 1. Owned trips
         trips_dict = {}
-        for doc in owned_query:
+        for doc in owned_future.result():
             trips_dict[doc.id] = doc.to_dict()
             trips_dict[doc.id]['id'] = doc.id
             trips_dict[doc.id]['is_owner'] = True
 
-        # 2. Fetch shared trips (if email provided)
-        if user_email:
-            shared_query = trips_ref.where('shared_with', 'array_contains', user_email).stream()
-            for doc in shared_query:
+        # 2. Shared trips (if email provided)
+        if shared_future:
+            for doc in shared_future.result():
                 if doc.id not in trips_dict:
                     trips_dict[doc.id] = doc.to_dict()
                     trips_dict[doc.id]['id'] = doc.id
                     trips_dict[doc.id]['is_owner'] = False
         
-        return list(trips_dict.values())
+        trips = list(trips_dict.values())
+        for trip in trips:
+            _remember_acl(trip['id'], trip)
+        _trips_cache.set(cache_key, trips)
+        return [dict(t) for t in trips]
     except Exception as e:
         print(f"Error fetching trips: {e}")
         return []
 
+def invalidate_user_trips(user_id=None, user_email=None):
+    """Drops cached trip lists for a user, matched by id or email."""
+    return _trips_cache.discard_where(
+        lambda key, _: (user_id is not None and key[0] == user_id) or
+                       (user_email is not None and key[1] == user_email))
+
+def invalidate_trip_lists(trip_id):
+    """Drops every cached trip list that contains trip_id."""
+    return _trips_cache.discard_where(
+        lambda _, trips: any(t.get('id') == trip_id for t in trips))
+
+def get_trips_cache_stats():
+    return _trips_cache.stats()
+
+# Trip access control. trip_id -> {'owner': user_id, 'shared_with': frozenset
+# of emails}, or _NO_TRIP for trips that don't exist. Every trip read (get_trip,
+# get_all_trips) primes it and share_trip / delete_trip keep it current, so an
+# access check is normally a dict lookup. Shares made through another worker
+# show up by TTL, or sooner through the re-read check_trip_access does before
+# denying.
+TRIP_ACL_TTL = float(os.getenv('TRIP_ACL_TTL', '300'))
+_acl_cache = TTLCache(maxsize=8192, ttl=TRIP_ACL_TTL)
+_NO_TRIP = {'owner': None, 'shared_with': frozenset()}
+
+def _remember_acl(trip_id, data):
+    acl = {'owner': data.get('user_id'), 'shared_with': frozenset(data.get('shared_with') or ())}
+    _acl_cache.set(trip_id, acl)
+    return acl
+
+def get_trip_acl(trip_id, refresh=False):
+    """Cached ACL for the trip (None if it doesn't exist). Raises if it can't be read."""
+    acl = None if refresh else _acl_cache.get(trip_id)
+    if acl is None:
+        doc = db.collection('trips').document(trip_id).get()
+        if doc.exists:
+            acl = _remember_acl(trip_id, doc.to_dict())
+        else:
+            acl = _NO_TRIP
+            _acl_cache.set(trip_id, _NO_TRIP)
+    return None if acl is _NO_TRIP else acl
+
+def _trip_role(acl, user_id, user_email):
+    if acl is None:
+        return None
+    if user_id and acl['owner'] == user_id:
+        return 'owner'
+    if user_email and user_email in acl['shared_with']:
+        return 'shared'
+    return None
+
+def check_trip_access(trip_id, user_id, user_email=None):
+    """
+    Returns 'owner', 'shared' or None (no access, or no such trip). A denial
+    from the cache is confirmed with one fresh read before it is returned.
+    Fails closed: None if Firestore is unavailable.
+    """
+    if not db or not trip_id:
+        return None
+    try:
+        role = _trip_role(get_trip_acl(trip_id), user_id, user_email)
+        if role is None:
+            role = _trip_role(get_trip_acl(trip_id, refresh=True), user_id, user_email)
+        return role
+    except Exception as e:
+        print(f"Error checking trip access: {e}")
+        return None
+
+def get_acl_cache_stats():
+    return _acl_cache.stats()
+
 def get_trip(trip_id):
     if not db:
         return None
@@ -70,6 +297,7 @@ def get_trip(trip_id):
         doc = db.collection('trips').document(trip_id).get()
         if doc.exists:
             trip = doc.to_dict()
+            _remember_acl(doc.id, trip)
             trip['id'] = doc.id
             if 'categories' not in trip:
                 trip['categories'] = ['General', 'Clothing', 'Toiletries', 'Electronics', 'Documents']
@@ -83,7 +311,7 @@ def add_trip(user_id, name, location, start_date=None, end_date=None, owner_emai
     if not db:
         return
     try:
-        db.collection('trips').add({
+        _, trip_ref = db.collection('trips').add({
             'user_id': user_id,
             'owner_email': owner_email,
             'shared_with': [],
@@ -92,8 +320,13 @@ def add_trip(user_id, name, location, start_date=None, end_date=None, owner_emai
             'start_date': start_date,
             'end_date': end_date,
             'categories': ['General', 'Clothing', 'Toiletries', 'Electronics', 'Documents'],
+            'summary': _empty_summary(),
+            'summary_ready': True,
+            'version': 0,
             'created_at': firestore.SERVER_TIMESTAMP
         })
+        _remember_acl(trip_ref.id, {'user_id': user_id})
+        invalidate_user_trips(user_id=user_id, user_email=owner_email)
     except Exception as e:
         print(f"Error adding trip: {e}")
 
@@ -102,29 +335,86 @@ def share_trip(trip_id, email):
         return False
     try:
         # Atomically add email to shared_with array
-        db.collection('trips').document(trip_id).update({
+        db.collection('trips').document(trip_id).update(_bump_version({
             'shared_with': firestore.ArrayUnion([email])
-        })
+        }))
+        _trip_changed(trip_id)
+        _acl_cache.update(trip_id, lambda acl: acl if acl is _NO_TRIP else
+                          {**acl, 'shared_with': acl['shared_with'] | {email}})
+        invalidate_trip_lists(trip_id)
+        invalidate_user_trips(user_email=email)
         return True
     except Exception as e:
         print(f"Error sharing trip: {e}")
         return False
 
-def delete_trip(trip_id):
+# Subcollections under trips/{trip_id} that go away with the trip
+TRIP_SUBCOLLECTIONS = ('private_notes', 'chat_history')
+
+def delete_trip(trip_id, cascade=True):
+    """
+    Deletes the trip document and, with cascade, everything that belongs to it
+    (see delete_trip_data). Pass cascade=False to delete the data later, e.g.
+    from a background job. A failed cascade raises (the trip document is gone
+    by then) so the caller can retry it.
+    """
     if not db:
         return
     try:
         db.collection('trips').document(trip_id).delete()
+        _acl_cache.set(trip_id, _NO_TRIP)
+        _trip_changed(trip_id)
+        invalidate_trip_lists(trip_id)
+        invalidate_trip_items(trip_id)
     except Exception as e:
         print(f"Error deleting trip: {e}")
+        return
+    if cascade:
+        delete_trip_data(trip_id)
+
+def _delete_query(query):
+    """Deletes every document matched by query, BATCH_LIMIT per read and commit. Returns the count."""
+    deleted = 0
+    while True:
+        # Keys only; the field data isn't needed to delete
+        docs = list(query.select([]).limit(BATCH_LIMIT).stream())
+        if not docs:
+            return deleted
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+        if len(docs) < BATCH_LIMIT:
+            return deleted
+
+def delete_trip_data(trip_id):
+    """
+    Deletes a trip's packing items and subcollections in chunked batches.
+    Safe to re-run (e.g. on retry); raises on failure so callers can retry.
+    Returns {'packing_items': n, 'notes': n, 'private_notes': n, 'chat_history': n}.
+    """
+    if not db:
+        return {}
+    counts = {'packing_items': _delete_query(db.collection('packing_items').where('trip_id', '==', trip_id))}
+    trip_ref = db.collection('trips').document(trip_id)
+    # Each user's notes live one level further down
+    counts['notes'] = sum(_delete_query(user_ref.collection('notes'))
+                          for user_ref in trip_ref.collection('private_notes').list_documents())
+    for name in TRIP_SUBCOLLECTIONS:
+        counts[name] = _delete_query(trip_ref.collection(name))
+    invalidate_trip_items(trip_id)
+    return counts
 
 def add_category_to_trip(trip_id, category_name):
     if not db:
         return False
     try:
-        db.collection('trips').document(trip_id).update({
+        result = db.collection('trips').document(trip_id).update(_bump_version({
             'categories': firestore.ArrayUnion([category_name])
-        })
+        }))
+        _trip_changed(trip_id)
+        _update_cached_items(trip_id, lambda items: items, [_committed_version(result)])
         return True
     except Exception as e:
         print(f"Error adding category: {e}")
@@ -134,66 +424,499 @@ def remove_category_from_trip(trip_id, category_name):
     if not db:
         return False
     try:
-        db.collection('trips').document(trip_id).update({
+        result = db.collection('trips').document(trip_id).update(_bump_version({
             'categories': firestore.ArrayRemove([category_name])
-        })
+        }))
+        _trip_changed(trip_id)
+        _update_cached_items(trip_id, lambda items: items, [_committed_version(result)])
         return True
     except Exception as e:
         print(f"Error removing category: {e}")
         return False
 
+# Trip Summary Functions
+# Each trip document carries a denormalized 'summary' of its items so headers,
+# filters and reminders don't need the packing_items collection:
+#   total, completed               - item counts
+#   categories   {category: n}
+#   contributors {added_by_name: {category: n}}
+#   unchecked    {added_by_email: {item_id: text}}
+# Item mutators apply deltas atomically with the item write. 'summary_ready'
+# marks trips whose summary has been built (legacy trips are backfilled once).
+
+def _summary_field(*parts):
+    # Quote each segment so emails/category names with dots stay one key
+    return FieldPath('summary', *parts).to_api_repr()
+
+def _empty_summary():
+    return {'total': 0, 'completed': 0, 'categories': {}, 'contributors': {}, 'unchecked': {}}
+
+def _summary_delta(item_id, data, sign, completed=None):
+    """
+    Field updates that add (sign=1) or remove (sign=-1) one item's contribution.
+    completed overrides data['is_completed'].
+    """
+    completed = data.get('is_completed', False) if completed is None else completed
+    category = data.get('category') or 'General'
+    updates = {
+        _summary_field('total'): firestore.Increment(sign),
+        _summary_field('categories', category): firestore.Increment(sign),
+    }
+    if completed:
+        updates[_summary_field('completed')] = firestore.Increment(sign)
+    if data.get('added_by_name'):
+        updates[_summary_field('contributors', data['added_by_name'], category)] = firestore.Increment(sign)
+    if data.get('added_by_email') and not completed:
+        updates[_summary_field('unchecked', data['added_by_email'], item_id)] = data.get('text') if sign > 0 else firestore.DELETE_FIELD
+    return updates
+
+def _toggle_delta(item_id, data, completed):
+    updates = {_summary_field('completed'): firestore.Increment(1 if completed else -1)}
+    if data.get('added_by_email'):
+        key = _summary_field('unchecked', data['added_by_email'], item_id)
+        updates[key] = firestore.DELETE_FIELD if completed else data.get('text')
+    return updates
+
+def _merge_deltas(target, updates):
+    # Combine several items' deltas into one trip update (Increments add up)
+    for key, value in updates.items():
+        if key in target and isinstance(value, firestore.Increment) and isinstance(target[key], firestore.Increment):
+            target[key] = firestore.Increment(target[key].value + value.value)
+        else:
+            target[key] = value
+    return target
+
+def build_trip_summary(items):
+    summary = _empty_summary()
+    for item in items:
+        category = item.get('category') or 'General'
+        summary['total'] += 1
+        summary['categories'][category] = summary['categories'].get(category, 0) + 1
+        if item.get('is_completed'):
+            summary['completed'] += 1
+        elif item.get('added_by_email'):
+            summary['unchecked'].setdefault(item['added_by_email'], {})[item['id']] = item.get('text')
+        if item.get('added_by_name'):
+            per_cat = summary['contributors'].setdefault(item['added_by_name'], {})
+            per_cat[category] = per_cat.get(category, 0) + 1
+    return summary
+
+def rebuild_trip_summary(trip_id):
+    """Recomputes a trip's summary from its items (backfill / repair)."""
+    if not db:
+        return _empty_summary()
+    summary = build_trip_summary(get_packing_items(trip_id))
+    try:
+        db.collection('trips').document(trip_id).update(_bump_version({'summary': summary, 'summary_ready': True}))
+        _trip_changed(trip_id)
+    except Exception as e:
+        print(f"Error saving trip summary: {e}")
+    return summary
+
+def get_trip_summary(trip_id, trip=None):
+    """
+    Returns the trip's summary, reading the trip document only if it isn't
+    passed in. Trips created before summaries existed are backfilled once.
+    """
+    if trip is None:
+        trip = get_trip(trip_id)
+    if trip and trip.get('summary_ready'):
+        summary = _empty_summary()
+        summary.update(trip.get('summary') or {})
+        return summary
+    return rebuild_trip_summary(trip_id)
+
+def summary_category_counts(summary, added_by_name=None):
+    """Category counts (optionally for one contributor) plus the contributor list."""
+    contributors = summary.get('contributors', {})
+    if added_by_name:
+        counts = contributors.get(added_by_name, {})
+    else:
+        counts = summary.get('categories', {})
+    counts = {cat: n for cat, n in counts.items() if n > 0}
+    active = sorted(name for name, per_cat in contributors.items() if any(n > 0 for n in per_cat.values()))
+    return {'counts': counts, 'contributors': active, 'total': sum(counts.values())}
+
+def get_unchecked_items(trip_id, user_email, trip=None):
+    """Texts of user_email's unchecked items, from the trip summary."""
+    summary = get_trip_summary(trip_id, trip)
+    return list(summary.get('unchecked', {}).get(user_email, {}).values())
+
+def get_trip_page(trip_id, user_id=None, include_notes=True, page_size=None, trip=None, include_items=True):
+    """
+    Loads everything the trip page needs with the reads issued concurrently.
+    Returns {'trip', 'items', 'next_cursor', 'private_note', 'notes_cursor'}.
+    Only the first page_size items and the first page of notes are read;
+    next_cursor / notes_cursor are None when that was all of them.
+    private_note is None when skipped. Pass trip when it has already been
+    read (the items are then at least as new as it); with
+    include_items=False, items is None.
+    """
+    page_size = page_size or EAGER_ITEMS_LIMIT
+    trip_future = _pool.submit(get_trip, trip_id) if trip is None else None
+    # Items read after the trip include every change up to its version, so
+    # only a cached list known to be at least that new may stand in for them
+    min_version = trip.get('version', 0) if trip is not None else None
+    items_future = _pool.submit(get_packing_items_page, trip_id, page_size, min_version=min_version) if include_items else None
+    notes_future = None
+    if include_notes and user_id:
+        notes_future = _pool.submit(get_user_trip_notes_page, trip_id, user_id)
+
+    page = items_future.result() if items_future else {'items': None, 'next_cursor': None}
+    notes = notes_future.result() if notes_future else None
+    return {
+        'trip': trip_future.result() if trip_future else trip,
+        'items': page['items'],
+        'next_cursor': page['next_cursor'],
+        'private_note': notes['notes'] if notes else None,
+        'notes_cursor': notes['next_cursor'] if notes else None
+    }
+
 # Packing List Functions
-def get_packing_items(trip_id):
+# Item timestamps are displayed in IST (UTC+5:30)
+IST = timezone(timedelta(hours=5, minutes=30))
+
+def _decode_item(doc):
+    item = doc.to_dict()
+    item['id'] = doc.id
+    return item
+
+def _created_at_key(item):
+    # Older items written with SERVER_TIMESTAMP may briefly have no created_at; sort them last
+    created = item.get('created_at')
+    return (created is None, created if created is not None else 0)
+
+def _creation_times(count):
+    """
+    created_at values for count new items, one microsecond apart, so a
+    multi-line paste reads back (and pages) in the order it was given even
+    though its chunks commit concurrently. SERVER_TIMESTAMP would give every
+    item of a batch the same value, leaving the order to the document ids.
+    """
+    base = datetime.now(timezone.utc)
+    return [base + timedelta(microseconds=i) for i in range(count)]
+
+def _format_items(items):
+    """Adds created_at_formatted to every decoded item in one pass."""
+    for item in items:
+        dt = item.get('created_at')
+        # Firestore returns timezone-aware UTC datetimes; anything else is left blank
+        if dt and hasattr(dt, 'astimezone'):
+            item['created_at_formatted'] = dt.astimezone(IST).strftime('%b %d, %I:%M %p')
+        else:
+            item['created_at_formatted'] = ''
+    return items
+
+def _new_cached_item(item_id, data):
+    # Local copy of a freshly written item, as it will read back
+    item = dict(data)
+    item['id'] = item_id
+    if not isinstance(item.get('created_at'), datetime):
+        item['created_at'] = datetime.now(timezone.utc)
+    return _format_items([item])[0]
+
+def _stop_item_listener(trip_id, _items):
+    watch = _item_listeners.pop(trip_id, None)
+    if watch is not None:
+        try:
+            watch.unsubscribe()
+        except Exception as e:
+            print(f"Error stopping item listener: {e}")
+
+# Per-trip item lists, kept fresh by the mutators below and optionally by
+# Firestore listeners so writes from other workers show up too. Entries are
+# (version, items): version is the trip version the list is known to include
+# every change up to, or None when that isn't known (see _cached_items).
+_item_cache = TTLCache(maxsize=int(os.getenv('ITEM_CACHE_SIZE', '256')),
+                       ttl=float(os.getenv('ITEM_CACHE_TTL', '15')),
+                       on_evict=_stop_item_listener)
+_item_listeners = {}
+ITEM_CACHE_LISTENERS = os.getenv('ITEM_CACHE_LISTENERS', '').lower() in ('1', 'true', 'yes')
+# Listener-fed entries are refreshed on every snapshot, so they can live longer
+ITEM_LISTENER_TTL = float(os.getenv('ITEM_LISTENER_TTL', '300'))
+
+def _cached_items(trip_id, min_version=None):
+    """
+    The cached item list, or None. With min_version, only if it is known to
+    include every change up to that trip version: writes made by other
+    workers don't reach this cache until it expires.
+    """
+    entry = _item_cache.get(trip_id) if trip_id else None
+    if entry is None:
+        return None
+    version, items = entry
+    if min_version is not None and (version is None or version < min_version):
+        return None
+    return items
+
+def _cache_items(trip_id, items, version=None, ttl=None):
+    _item_cache.set(trip_id, (version, items), ttl=ttl)
+
+def _update_cached_items(trip_id, func, versions=()):
+    """
+    Write-through of this worker's own writes. versions are the trip versions
+    those writes produced: when they directly follow the list's version nobody
+    else wrote in between, so the list moves up to the newest of them and the
+    next page view can still use it. Otherwise it keeps its version.
+    """
+    versions = sorted(versions) if versions and None not in versions else []
+
+    def apply(entry):
+        version, items = entry
+        if version is not None and versions == list(range(version + 1, version + 1 + len(versions))) and versions:
+            version = versions[-1]
+        return version, func(items)
+    return _item_cache.update(trip_id, apply)
+
+def _start_item_listener(trip_id):
+    if trip_id in _item_listeners:
+        return
+
+    def on_snapshot(docs, changes, read_time):
+        if trip_id not in _item_listeners:
+            return
+        items = sorted((_decode_item(d) for d in docs), key=_created_at_key)
+        _cache_items(trip_id, _format_items(items), ttl=ITEM_LISTENER_TTL)
+        _trip_changed(trip_id)
+
+    try:
+        query = db.collection('packing_items').where('trip_id', '==', trip_id)
+        _item_listeners[trip_id] = None
+        _item_listeners[trip_id] = query.on_snapshot(on_snapshot)
+    except Exception as e:
+        _item_listeners.pop(trip_id, None)
+        print(f"Error starting item listener: {e}")
+
+def watch_trip(trip_id, on_items, on_trip):
+    """
+    Listens to a trip and its packing items (used by trip_sync.py).
+    on_items(items) gets the whole formatted item list, oldest first, on
+    every change; on_trip(trip) the trip dict, or None once it is deleted.
+    Both are called once with the current state first. The items also keep
+    this worker's item cache fresh while the watch runs. Returns a function
+    that stops both listeners, or None when they couldn't be started.
+    """
+    if not db:
+        return None
+
+    def items_snapshot(docs, changes, read_time):
+        items = _format_items(sorted((_decode_item(d) for d in docs), key=_created_at_key))
+        _cache_items(trip_id, [dict(i) for i in items], ttl=ITEM_LISTENER_TTL)
+        _trip_changed(trip_id)
+        on_items(items)
+
+    def trip_snapshot(docs, changes, read_time):
+        doc = docs[0] if docs else None
+        if doc is None or not doc.exists:
+            _acl_cache.set(trip_id, _NO_TRIP)
+            on_trip(None)
+            return
+        trip = doc.to_dict()
+        _remember_acl(trip_id, trip)
+        trip['id'] = doc.id
+        on_trip(trip)
+
+    watches = []
+    try:
+        watches.append(db.collection('trips').document(trip_id).on_snapshot(trip_snapshot))
+        watches.append(db.collection('packing_items').where('trip_id', '==', trip_id).on_snapshot(items_snapshot))
+    except Exception as e:
+        print(f"Error starting trip watch: {e}")
+        for watch in watches:
+            watch.unsubscribe()
+        return None
+
+    def stop():
+        for watch in watches:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                print(f"Error stopping trip watch: {e}")
+    return stop
+
+def _update_cached_item(item_id, trip_id, changes=None, version=None):
+    """
+    Applies changes to the cached copy of item_id, or removes it when changes is
+    None. Scans the cached trips when trip_id is not known. version is the trip
+    version the write produced, if known (see _update_cached_items).
+    """
+    found = []
+
+    def apply(items):
+        if not any(i.get('id') == item_id for i in items):
+            return items
+        found.append(True)
+        if changes is None:
+            return [i for i in items if i.get('id') != item_id]
+        return [dict(i, **changes) if i.get('id') == item_id else i for i in items]
+
+    trip_ids = [trip_id] if trip_id else _item_cache.keys()
+    for tid in trip_ids:
+        _update_cached_items(tid, apply, [version] if tid == trip_id else ())
+        if found:
+            return
+
+def invalidate_trip_items(trip_id):
+    _item_cache.pop(trip_id)
+
+def get_item_cache_stats():
+    stats = _item_cache.stats()
+    stats['listeners'] = len(_item_listeners)
+    return stats
+
+def get_packing_items(trip_id, min_version=None):
+    """
+    All of a trip's items, oldest first. min_version is a trip version read
+    before this call; a cached list older than it is not used.
+    """
     if not db:
         return []
+    cached = _cached_items(trip_id, min_version)
+    if cached is not None:
+        return [dict(i) for i in cached]
     try:
         items_ref = db.collection('packing_items')
         
-        try:
-            # Try fetching ordered by created_at (requires composite index)
-            query = items_ref.where('trip_id', '==', trip_id).order_by('created_at', direction=firestore.Query.ASCENDING).stream()
-            # Convert to list to trigger execution and potential error
-            doc_list = list(query)
-        except Exception:
-            # Index missing or query failed. Falling back to in-memory sorting.
-            # This is expected behavior until the index is built.
-            query = items_ref.where('trip_id', '==', trip_id).stream()
-            doc_list = list(query)
-            # Sort manually by created_at (handling None values safely)
-            doc_list.sort(key=lambda x: x.to_dict().get('created_at') or 0)
-
-        items = []
-        for doc in doc_list:
-            item = doc.to_dict()
-            item['id'] = doc.id
-            # Format timestamp for display (IST: UTC+5:30)
-            if 'created_at' in item and item['created_at']:
-                # Convert Firestore Timestamp to datetime value 
-                dt = item['created_at']
-                # Check if it's already a datetime object (sometimes wrapper handles it) or Timestamp
-                if hasattr(dt, 'strftime'):
-                    # Create a fixed timezone offset for IST (UTC+5:30) without external deps if possible,
-                    # but datetime.timezone is available in Python 3.2+
-                    from datetime import timezone, timedelta
-                    ist = timezone(timedelta(hours=5, minutes=30))
-                    # dt from firestore is usually timezone-aware UTC. Convert to IST.
-                    dt_ist = dt.astimezone(ist)
-                    item['created_at_formatted'] = dt_ist.strftime('%b %d, %I:%M %p')
-                else: 
-                     item['created_at_formatted'] = ''
-            else:
-                 item['created_at_formatted'] = ''
-            items.append(item)
-        return items
+        items = None
+        if _has_items_index():
+            try:
+                query = items_ref.where('trip_id', '==', trip_id).order_by('created_at', direction=firestore.Query.ASCENDING)
+                items = [_decode_item(doc) for doc in query.stream()]
+            except Exception as e:
+                if _index_missing(e):
+                    # Index was dropped or is still building; stop trying it on every load
+                    _mark_items_index(False)
+                print(f"Ordered items query failed, using in-memory sort: {e}")
+        
+        if items is None:
+            # Decode each snapshot once, then sort the plain records
+            items = [_decode_item(doc) for doc in items_ref.where('trip_id', '==', trip_id).stream()]
+            items.sort(key=_created_at_key)
+
+        _format_items(items)
+        _cache_items(trip_id, items, min_version)
+        if ITEM_CACHE_LISTENERS:
+            _start_item_listener(trip_id)
+        return [dict(i) for i in items]
     except Exception as e:
         print(f"Error fetching packing items: {e}")
         return []
 
+def _item_cursor(item):
+    """
+    Page cursor for item: its id and, when known, its created_at, so the next
+    page's query can start after those values without reading the item.
+    """
+    created = item.get('created_at')
+    if hasattr(created, 'isoformat'):
+        return f"{item['id']}@{created.isoformat()}"
+    return item['id']
+
+def _parse_item_cursor(cursor):
+    item_id, _, created = cursor.partition('@')
+    try:
+        return item_id, datetime.fromisoformat(created) if created else None
+    except ValueError:
+        return item_id, None
+
+def _page_from_list(items, page_size, start_after=None, category=None, added_by_name=None):
+    if category is not None:
+        items = [i for i in items if i.get('category', 'General') == category]
+    if added_by_name:
+        items = [i for i in items if i.get('added_by_name') == added_by_name]
+    start = 0
+    if start_after:
+        after_id, _ = _parse_item_cursor(start_after)
+        for index, item in enumerate(items):
+            if item.get('id') == after_id:
+                start = index + 1
+                break
+    page = [dict(i) for i in items[start:start + page_size]]
+    has_more = start + page_size < len(items)
+    return {'items': page, 'next_cursor': _item_cursor(page[-1]) if has_more and page else None}
+
+# Filter shapes, (category?, added_by_name?), whose composite index (see
+# firestore.indexes.json) turned out to be missing, with when that was seen.
+# They page the trip's cached list instead until ITEMS_INDEX_RECHECK passes.
+_page_index_missing = {}
+
+def _page_query_available(shape):
+    if shape == (False, False):
+        return _has_items_index()
+    missing_at = _page_index_missing.get(shape)
+    return missing_at is None or time.monotonic() - missing_at >= ITEMS_INDEX_RECHECK
+
+def get_packing_items_page(trip_id, page_size=None, start_after=None, category=None, added_by_name=None, min_version=None):
+    """
+    Returns one page of a trip's items, oldest first, as {'items', 'next_cursor'}.
+    start_after is the previous page's next_cursor. Served from the item cache
+    when warm (and, with min_version, at least that new), otherwise with a
+    Firestore query that starts after the cursor's values.
+    """
+    page_size = page_size or ITEMS_PAGE_SIZE
+    if not db:
+        return {'items': [], 'next_cursor': None}
+
+    cached = _cached_items(trip_id, min_version)
+    if cached is not None:
+        return _page_from_list(cached, page_size, start_after, category, added_by_name)
+
+    shape = (category is not None, bool(added_by_name))
+    after_id, after_created = _parse_item_cursor(start_after) if start_after else (None, None)
+    try:
+        if not _page_query_available(shape):
+            raise LookupError('ordered items query unavailable')
+        items_ref = db.collection('packing_items')
+        query = items_ref.where('trip_id', '==', trip_id)
+        if category is not None:
+            query = query.where('category', '==', category)
+        if added_by_name:
+            query = query.where('added_by_name', '==', added_by_name)
+        # The document id breaks created_at ties, so a value cursor is exact
+        query = query.order_by('created_at', direction=firestore.Query.ASCENDING).order_by(FieldPath.document_id())
+        if after_created is not None:
+            query = query.start_after({'created_at': after_created, FieldPath.document_id(): items_ref.document(after_id)})
+        elif after_id:
+            # Cursor without a created_at (the item had none yet); read it
+            query = query.start_after(items_ref.document(after_id).get())
+        # Fetch one extra document to know whether another page exists
+        items = [_decode_item(doc) for doc in query.limit(page_size + 1).stream()]
+    except Exception as e:
+        # Without the composite index for this filter, page the trip's list
+        # (one ordered query, then cached) and don't try the query again for a while
+        if _index_missing(e):
+            if shape == (False, False):
+                _mark_items_index(False)
+            else:
+                _page_index_missing[shape] = time.monotonic()
+        if not isinstance(e, LookupError):
+            print(f"Paged items query failed, paging in memory: {e}")
+        return _page_from_list(get_packing_items(trip_id, min_version), page_size, start_after, category, added_by_name)
+
+    _page_index_missing.pop(shape, None)
+    has_more = len(items) > page_size
+    items = _format_items(items[:page_size])
+    if not has_more and not start_after and shape == (False, False):
+        # The first page holds the whole trip, so it doubles as a cache fill
+        _cache_items(trip_id, items, min_version)
+    items = [dict(i) for i in items]
+    return {'items': items, 'next_cursor': _item_cursor(items[-1]) if has_more and items else None}
+
+def get_item_category_counts(trip_id, added_by_name=None, trip=None):
+    """
+    Counts a trip's items per category without loading them, for the lazy
+    trip page. Returns {'counts', 'contributors', 'total'}; counts honour
+    added_by_name, contributors cover every item.
+    """
+    if not db:
+        return {'counts': {}, 'contributors': [], 'total': 0}
+    return summary_category_counts(get_trip_summary(trip_id, trip), added_by_name)
+
 def add_packing_item(trip_id, text, category='General', added_by_email=None, added_by_name=None, note=None):
     if not db:
         return
     try:
-        db.collection('packing_items').add({
+        data = {
             'trip_id': trip_id,
             'text': text,
             'category': category,
@@ -201,122 +924,545 @@ def add_packing_item(trip_id, text, category='General', added_by_email=None, add
             'added_by_name': added_by_name,
             'note': note,
             'is_completed': False,
-            'created_at': firestore.SERVER_TIMESTAMP
-        })
+            'created_at': _creation_times(1)[0]
+        }
+        doc_ref = db.collection('packing_items').document()
+        batch = db.batch()
+        batch.set(doc_ref, data)
+        batch.update(db.collection('trips').document(trip_id), _bump_version(_summary_delta(doc_ref.id, data, 1)))
+        write_results = batch.commit()
+        _trip_changed(trip_id)
+        _update_cached_items(trip_id, lambda items: items + [_new_cached_item(doc_ref.id, data)],
+                             [_committed_version(write_results[-1])])
     except Exception as e:
         print(f"Error adding packing item: {e}")
 
-def toggle_packing_item(item_id, current_status):
+def add_packing_items(trip_id, texts, category='General', added_by_email=None, added_by_name=None, note=None):
+    """
+    Adds many items using write batches (one commit per 499 items plus the trip
+    summary update), committing the chunks concurrently. texts is either a list of strings or a list of dicts with
+    'text' and optional 'category' / 'note' overrides.
+    Returns one {'text', 'id', 'ok'} result per input item, in order; the ok
+    ones also carry the new 'item' as it would be read back (created_at is
+    this server's clock until Firestore's timestamp is read).
+    """
+    entries = []
+    for entry in texts:
+        if isinstance(entry, dict):
+            entries.append({
+                'text': entry.get('text'),
+                'category': entry.get('category') or category,
+                'note': entry.get('note', note),
+            })
+        else:
+            entries.append({'text': entry, 'category': category, 'note': note})
+    for entry, created_at in zip(entries, _creation_times(len(entries))):
+        entry['created_at'] = created_at
+
     if not db:
-        return
+        return [{'text': e['text'], 'id': None, 'ok': False} for e in entries]
+
+    items_ref = db.collection('packing_items')
+    trip_ref = db.collection('trips').document(trip_id)
+
+    versions = []
+
+    def commit_chunk(chunk):
+        batch = db.batch()
+        results = []
+        summary_updates = {}
+        for e in chunk:
+            doc_ref = items_ref.document()
+            data = {
+                'trip_id': trip_id,
+                'text': e['text'],
+                'category': e['category'],
+                'added_by_email': added_by_email,
+                'added_by_name': added_by_name,
+                'note': e['note'],
+                'is_completed': False,
+                'created_at': e['created_at']
+            }
+            batch.set(doc_ref, data)
+            _merge_deltas(summary_updates, _summary_delta(doc_ref.id, data, 1))
+            results.append({'text': e['text'], 'id': doc_ref.id, 'ok': True, 'data': data})
+        batch.update(trip_ref, _bump_version(summary_updates))
+        try:
+            versions.append(_committed_version(batch.commit()[-1]))
+        except Exception as ex:
+            print(f"Error adding packing items batch: {ex}")
+            for r in results:
+                r['id'] = None
+                r['ok'] = False
+        return results
+
+    futures = [_pool.submit(commit_chunk, chunk) for chunk in _chunks(entries, BATCH_LIMIT - 1)]
+    results = []
+    for future in futures:
+        results.extend(future.result())
+
+    new_items = []
+    for r in results:
+        data = r.pop('data')
+        if r['ok']:
+            r['item'] = _new_cached_item(r['id'], data)
+            new_items.append(r['item'])
+    if new_items:
+        _trip_changed(trip_id)
+        _update_cached_items(trip_id, lambda items: items + [dict(i) for i in new_items], versions)
+    return results
+
+def _item_snapshot_data(snapshot, trip_id):
+    # None unless the item exists and (when trip_id is given) belongs to that trip
+    if not snapshot.exists:
+        return None
+    data = snapshot.to_dict()
+    if trip_id is not None and data.get('trip_id') != trip_id:
+        return None
+    return data
+
+# The transactions below return (item data, new trip version); either is None
+# when nothing was written or the version wasn't read.
+def _set_item_completed(transaction, item_ref, completed, trip_id=None):
+    snapshot, version = _read_with_trip(transaction, item_ref, trip_id)
+    data = _item_snapshot_data(snapshot, trip_id)
+    if data is None:
+        return None, None
+    if bool(data.get('is_completed')) == completed:
+        # Already in the requested state (stale link / double click); nothing to count
+        return data, None
+    transaction.update(item_ref, {'is_completed': completed})
+    transaction.update(db.collection('trips').document(data['trip_id']),
+                       _bump_version(_toggle_delta(item_ref.id, data, completed), version))
+    return data, version + 1 if version is not None else None
+
+def _delete_item(transaction, item_ref, trip_id=None):
+    snapshot, version = _read_with_trip(transaction, item_ref, trip_id)
+    data = _item_snapshot_data(snapshot, trip_id)
+    if data is None:
+        return None, None
+    transaction.delete(item_ref)
+    transaction.update(db.collection('trips').document(data['trip_id']),
+                       _bump_version(_summary_delta(item_ref.id, data, -1), version))
+    return data, version + 1 if version is not None else None
+
+def get_packing_item(item_id, trip_id=None):
+    """Single item, from the trip's cached list when available."""
+    if not db:
+        return None
+    cached = _cached_items(trip_id)
+    if cached is not None:
+        for item in cached:
+            if item.get('id') == item_id:
+                return dict(item)
     try:
-        db.collection('packing_items').document(item_id).update({
-            'is_completed': not current_status
-        })
+        doc = db.collection('packing_items').document(item_id).get()
+        if _item_snapshot_data(doc, trip_id) is not None:
+            return _format_items([_decode_item(doc)])[0]
+        return None
+    except Exception as e:
+        print(f"Error fetching packing item: {e}")
+        return None
+
+def toggle_packing_item(item_id, current_status, trip_id=None):
+    """Flips is_completed and returns the updated item (None on failure)."""
+    if not db:
+        return None
+    try:
+        item_ref = db.collection('packing_items').document(item_id)
+        data, version = firestore.transactional(_set_item_completed)(db.transaction(), item_ref, not current_status, trip_id)
+        _update_cached_item(item_id, trip_id, {'is_completed': not current_status}, version)
+        _trip_changed(trip_id or (data or {}).get('trip_id'))
+        if data is None:
+            return None
+        data['id'] = item_id
+        data['is_completed'] = not current_status
+        return _format_items([data])[0]
     except Exception as e:
         print(f"Error toggling item: {e}")
+        return None
 
 
-def delete_packing_item(item_id):
+def delete_packing_item(item_id, trip_id=None):
+    """Deletes the item and returns its last stored data (None if missing)."""
     if not db:
-        return
+        return None
     try:
-        db.collection('packing_items').document(item_id).delete()
+        item_ref = db.collection('packing_items').document(item_id)
+        data, version = firestore.transactional(_delete_item)(db.transaction(), item_ref, trip_id)
+        _update_cached_item(item_id, trip_id, version=version)
+        _trip_changed(trip_id or (data or {}).get('trip_id'))
+        if data is not None:
+            data['id'] = item_id
+        return data
     except Exception as e:
         print(f"Error deleting item: {e}")
+        return None
 
-def delete_packing_item_by_text(trip_id, text):
+def normalize_item_text(text):
+    # "  Phone  Charger" == "phone charger"
+    return ' '.join((text or '').casefold().split())
+
+def _build_text_index(items):
+    """normalized text -> matching items, oldest first."""
+    index = {}
+    for item in items:
+        index.setdefault(normalize_item_text(item.get('text')), []).append(item)
+    return index
+
+def _apply_actions(transaction, trip_ref, deletes, adds):
+    """
+    Re-reads the matched items in one get_all, then writes every delete, add
+    and the combined summary delta in the same commit. Returns the ids of the
+    deletes that were still there and the new trip version.
+    """
+    # The trip is read along with them so the new version is known
+    snapshots = list(transaction.get_all([ref for ref, _ in deletes] + [trip_ref]))
+    trip = next((snap for snap in snapshots if snap.reference.path == trip_ref.path), None)
+    version = (trip.to_dict() or {}).get('version', 0) if trip is not None and trip.exists else None
+    existing = {snap.id: snap.to_dict() for snap in snapshots
+                if snap.exists and snap.reference.path != trip_ref.path}
+    summary_updates = {}
+    for ref, _ in deletes:
+        if ref.id in existing:
+            transaction.delete(ref)
+            _merge_deltas(summary_updates, _summary_delta(ref.id, existing[ref.id], -1))
+    for ref, data in adds:
+        transaction.set(ref, data)
+        _merge_deltas(summary_updates, _summary_delta(ref.id, data, 1))
+    if not summary_updates:
+        return set(existing), None
+    transaction.update(trip_ref, _bump_version(summary_updates, version))
+    return set(existing), version + 1 if version is not None else None
+
+def apply_item_actions(trip_id, actions, added_by_email=None, added_by_name=None):
+    """
+    Applies chat actions ({'type': 'add'|'delete', 'item', 'category', 'note'})
+    to a trip. Item names are resolved against one read of the trip's items,
+    ignoring case and extra whitespace, and all writes go out in one
+    transaction (chunked only past Firestore's 500-write limit).
+    Returns one {'type', 'item', 'id', 'ok', 'error'} result per action, in order.
+    """
+    results = [{'type': a.get('type'), 'item': a.get('item'), 'id': None, 'ok': False, 'error': None}
+               for a in actions]
     if not db:
-        return
-    try:
-        # Find items with matching text in the trip
-        # Limit to 1 to avoid accidental mass deletion, but ideally we'd pass an ID.
-        # AI works with names, so we'll delete the first match.
-        docs = db.collection('packing_items').where('trip_id', '==', trip_id).where('text', '==', text).stream()
-        for doc in docs:
-            doc.reference.delete()
-            # Only delete one
-            return
-    except Exception as e:
-        print(f"Error deleting item by text: {e}")
+        for r in results:
+            r['error'] = 'unavailable'
+        return results
+
+    index = _build_text_index(get_packing_items(trip_id))
+    items_ref = db.collection('packing_items')
+    trip_ref = db.collection('trips').document(trip_id)
+    # Added items keep the order the actions came in
+    creation_times = iter(_creation_times(len(actions)))
+
+    writes = []  # (result, 'delete'|'add', doc_ref, data)
+    for action, result in zip(actions, results):
+        text = (action.get('item') or '').strip()
+        if action.get('type') == 'delete':
+            matches = index.get(normalize_item_text(text))
+            if not matches:
+                result['error'] = 'not found'
+                continue
+            # Each delete claims one item, so "delete socks" twice removes two pairs
+            item = matches.pop(0)
+            result['id'] = item['id']
+            writes.append((result, 'delete', items_ref.document(item['id']), item))
+        elif action.get('type') == 'add' and text:
+            doc_ref = items_ref.document()
+            data = {
+                'trip_id': trip_id,
+                'text': text,
+                'category': action.get('category') or 'General',
+                'added_by_email': added_by_email,
+                'added_by_name': added_by_name,
+                'note': action.get('note'),
+                'is_completed': False,
+                'created_at': next(creation_times)
+            }
+            result['id'] = doc_ref.id
+            writes.append((result, 'add', doc_ref, data))
+        else:
+            result['error'] = 'invalid action'
+
+    deleted_ids = set()
+    new_items = []
+    versions = []
+    # Leave room for the trip summary update in each commit
+    for chunk in _chunks(writes, BATCH_LIMIT - 1):
+        deletes = [(ref, data) for _, kind, ref, data in chunk if kind == 'delete']
+        adds = [(ref, data) for _, kind, ref, data in chunk if kind == 'add']
+        try:
+            present, version = firestore.transactional(_apply_actions)(db.transaction(), trip_ref, deletes, adds)
+        except Exception as e:
+            print(f"Error applying item actions: {e}")
+            for result, _, _, _ in chunk:
+                result['id'] = None
+                result['error'] = 'write failed'
+            continue
+        for result, kind, ref, data in chunk:
+            if kind == 'add':
+                result['ok'] = True
+                new_items.append(_new_cached_item(ref.id, data))
+            elif ref.id in present:
+                result['ok'] = True
+            else:
+                result['error'] = 'not found'
+        # Missing ones were deleted elsewhere, so drop them from the cache too
+        deleted_ids.update(ref.id for ref, _ in deletes)
+        if version is not None:
+            versions.append(version)
 
-def update_packing_item_note(item_id, new_note):
+    if deleted_ids or new_items:
+        _trip_changed(trip_id)
+        _update_cached_items(trip_id, lambda items: [i for i in items if i.get('id') not in deleted_ids] + new_items,
+                             versions)
+    return results
+
+def delete_packing_item_by_text(trip_id, text):
+    """Deletes the oldest item whose text matches (case/whitespace-insensitive)."""
+    results = apply_item_actions(trip_id, [{'type': 'delete', 'item': text}])
+    return results[0]['ok']
+
+def _update_item_note(transaction, item_ref, new_note, trip_id):
+    # Returns (updated, new trip version)
+    snapshot, version = _read_with_trip(transaction, item_ref, trip_id)
+    if _item_snapshot_data(snapshot, trip_id) is None:
+        return False, None
+    transaction.update(item_ref, {'note': new_note})
+    transaction.update(db.collection('trips').document(trip_id), _bump_version(current=version))
+    return True, version + 1 if version is not None else None
+
+def update_packing_item_note(item_id, new_note, trip_id=None):
+    """Sets the item's note. With trip_id, only if the item belongs to that trip."""
     if not db:
         return False
     try:
-        db.collection('packing_items').document(item_id).update({
-            'note': new_note
-        })
+        item_ref = db.collection('packing_items').document(item_id)
+        cached = _cached_items(trip_id)
+        version = None
+        if trip_id is None:
+            item_ref.update({'note': new_note})
+        elif cached is not None and any(i.get('id') == item_id for i in cached):
+            batch = db.batch()
+            batch.update(item_ref, {'note': new_note})
+            batch.update(db.collection('trips').document(trip_id), _bump_version())
+            version = _committed_version(batch.commit()[-1])
+        else:
+            updated, version = firestore.transactional(_update_item_note)(db.transaction(), item_ref, new_note, trip_id)
+            if not updated:
+                return False
+        _trip_changed(trip_id)
+        _update_cached_item(item_id, trip_id, {'note': new_note}, version)
         return True
     except Exception as e:
         print(f"Error updating note: {e}")
         return False
 
 # Private Notes Functions
-def get_user_trip_note(trip_id, user_id):
+# Each note is its own document under trips/{trip_id}/private_notes/{user_id}/notes,
+# read newest first a page at a time. Older versions kept every note in a
+# 'notes' array (or a single 'content' string) on the user's document; that is
+# moved into the subcollection on first access, or in bulk with
+# migrate_private_notes.py.
+NOTES_PAGE_SIZE = int(os.getenv('NOTES_PAGE_SIZE', '20'))
+
+# (trip_id, user_id) pairs already known to be migrated in this process
+_migrated_notes = TTLCache(maxsize=4096, ttl=3600)
+
+def _notes_parent(trip_id, user_id):
+    return db.collection('trips').document(trip_id).collection('private_notes').document(user_id)
+
+def _note_time(value):
+    # Legacy notes stored ISO strings; new ones store timestamps
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime) and value.tzinfo is None:
+        # Firestore treats naive datetimes as UTC anyway; make that explicit
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def _decode_note(doc):
+    note = doc.to_dict()
+    note['id'] = doc.id
+    created = note.get('created_at')
+    note['created_at'] = created.isoformat() if hasattr(created, 'isoformat') else (created or '')
+    return note
+
+def _migrate_note_doc(parent_ref, data):
+    """Moves a legacy notes array / content field into the subcollection. Returns notes moved."""
+    legacy = list(data.get('notes') or [])
+    if not legacy and data.get('content'):
+        legacy = [{'id': 'legacy', 'text': data['content'], 'created_at': data.get('updated_at')}]
+    notes_ref = parent_ref.collection('notes')
+    writes = [(notes_ref.document(note.get('id') or None),
+               {'text': note.get('text', ''), 'created_at': _note_time(note.get('created_at')) or firestore.SERVER_TIMESTAMP})
+              for note in legacy]
+    # The legacy fields are dropped in the last batch, so a failed run is simply repeated
+    chunks = list(_chunks(writes, BATCH_LIMIT - 1)) or [[]]
+    for i, chunk in enumerate(chunks):
+        batch = db.batch()
+        for ref, note in chunk:
+            batch.set(ref, note)
+        if i == len(chunks) - 1:
+            batch.set(parent_ref, {'notes': firestore.DELETE_FIELD, 'content': firestore.DELETE_FIELD,
+                                   'migrated': True}, merge=True)
+        batch.commit()
+    return len(writes)
+
+def _ensure_notes_migrated(trip_id, user_id):
+    if (trip_id, user_id) in _migrated_notes:
+        return
+    parent_ref = _notes_parent(trip_id, user_id)
+    doc = parent_ref.get()
+    data = doc.to_dict() if doc.exists else {}
+    if data.get('notes') or data.get('content'):
+        _migrate_note_doc(parent_ref, data)
+    _migrated_notes.set((trip_id, user_id), True)
+
+def get_user_trip_notes_page(trip_id, user_id, page_size=None, start_after=None):
+    """
+    One page of the user's private notes, newest first, as {'notes', 'next_cursor'}.
+    start_after is the id of the last note of the previous page.
+    """
+    page_size = page_size or NOTES_PAGE_SIZE
     if not db:
-        return []
+        return {'notes': [], 'next_cursor': None}
     try:
-        doc = db.collection('trips').document(trip_id).collection('private_notes').document(user_id).get()
-        if doc.exists:
-            data = doc.to_dict()
-            # Return the list of notes, defaulting to empty list
-            if 'notes' in data:
-                notes = data['notes']
-                # Ensure created_at is string
-                for note in notes:
-                    if 'created_at' in note and not isinstance(note['created_at'], str):
-                         # Try simple string conversion or isoformat
-                         try:
-                             note['created_at'] = note['created_at'].isoformat()
-                         except:
-                             note['created_at'] = str(note['created_at'])
-                return notes
-            elif 'content' in data:
-                # Migrate old single note to list
-                created = data.get('updated_at')
-                if created and not isinstance(created, str):
-                    try:
-                        created = created.isoformat()
-                    except:
-                        created = str(created)
-                return [{'id': 'legacy', 'text': data['content'], 'created_at': created}]
-        return []
+        _ensure_notes_migrated(trip_id, user_id)
+        notes_ref = _notes_parent(trip_id, user_id).collection('notes')
+        query = notes_ref.order_by('created_at', direction=firestore.Query.DESCENDING)
+        if start_after:
+            query = query.start_after(notes_ref.document(start_after).get())
+        # Fetch one extra document to know whether another page exists
+        notes = [_decode_note(doc) for doc in query.limit(page_size + 1).stream()]
+        has_more = len(notes) > page_size
+        notes = notes[:page_size]
+        return {'notes': notes, 'next_cursor': notes[-1]['id'] if has_more and notes else None}
     except Exception as e:
         print(f"Error fetching private notes: {e}")
-        return []
+        return {'notes': [], 'next_cursor': None}
+
+def get_user_trip_note(trip_id, user_id):
+    """First page of the user's private notes, newest first."""
+    return get_user_trip_notes_page(trip_id, user_id)['notes']
 
 def save_user_trip_note(trip_id, user_id, content):
     if not db:
         return False
     try:
-        # Create a new note object
-        import uuid
-        from datetime import datetime
-        
-        new_note = {
-            'id': str(uuid.uuid4()),
+        _ensure_notes_migrated(trip_id, user_id)
+        parent_ref = _notes_parent(trip_id, user_id)
+        batch = db.batch()
+        batch.set(parent_ref.collection('notes').document(), {
             'text': content,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        doc_ref = db.collection('trips').document(trip_id).collection('private_notes').document(user_id)
-        
-        # Use array_union to append
-        # Note: array_union might not work well if we want to store complex objects unless they are exact matches? 
-        # Actually for appending new unique objects it's fine.
-        # But to be safe and allow setting fields, let's use set with merge if doc doesn't exist, 
-        # or update if it does.
-        
-        # Checking existence to decide between set (create) and update (append) is one way.
-        # Or just use set(..., merge=True) with array_union.
-        
-        doc_ref.set({
-            'notes': firestore.ArrayUnion([new_note]),
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }, merge=True)
-        
+            'created_at': datetime.now(timezone.utc)
+        })
+        # Keep the parent document so cascades and compaction can find the notes
+        batch.set(parent_ref, {'migrated': True, 'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+        batch.commit()
         return True
     except Exception as e:
         print(f"Error saving private note: {e}")
         return False
+
+def migrate_private_notes():
+    """Migrates every user's legacy notes in one pass. Returns {'users', 'notes'} migrated."""
+    report = {'users': 0, 'notes': 0}
+    if not db:
+        return report
+    for doc in db.collection_group('private_notes').stream():
+        data = doc.to_dict() or {}
+        if data.get('notes') or data.get('content'):
+            report['notes'] += _migrate_note_doc(doc.reference, data)
+            report['users'] += 1
+    return report
+
+# Orphan compaction (offline; see compact_orphans.py)
+
+def estimate_doc_size(path, data):
+    """Approximate stored size in bytes, following Firestore's storage size rules."""
+    def value_size(value):
+        if value is None or isinstance(value, bool):
+            return 1
+        if isinstance(value, (int, float)) or hasattr(value, 'timestamp'):
+            return 8
+        if isinstance(value, str):
+            return len(value.encode('utf-8')) + 1
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        if isinstance(value, dict):
+            return sum(len(k.encode('utf-8')) + 1 + value_size(v) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return sum(value_size(v) for v in value)
+        return 16
+    name_size = sum(len(part.encode('utf-8')) + 1 for part in path.split('/')) + 16
+    return name_size + value_size(data or {}) + 32
+
+def _existing_trip_ids(trip_ids):
+    refs = [db.collection('trips').document(tid) for tid in trip_ids]
+    existing = set()
+    for chunk in _chunks(refs, 100):
+        existing.update(snap.id for snap in db.get_all(chunk) if snap.exists)
+    return existing
+
+def compact_orphans(dry_run=False):
+    """
+    Finds packing items, private notes and chat history whose trip no longer
+    exists and deletes them in batches (unless dry_run). Returns a report with
+    per-collection document counts and estimated bytes reclaimed.
+    """
+    report = {'dry_run': dry_run, 'orphan_trips': 0, 'collections': {}}
+    if not db:
+        return report
+
+    # Every document grouped by the trip it belongs to
+    candidates = {}  # trip_id -> [(collection, doc_ref, size)]
+    for doc in db.collection('packing_items').stream():
+        data = doc.to_dict() or {}
+        size = estimate_doc_size(f'packing_items/{doc.id}', data)
+        candidates.setdefault(data.get('trip_id'), []).append(('packing_items', doc.reference, size))
+    for name in TRIP_SUBCOLLECTIONS:
+        for doc in db.collection_group(name).stream():
+            trip_ref = doc.reference.parent.parent
+            if trip_ref is None:
+                continue
+            size = estimate_doc_size(f'trips/{trip_ref.id}/{name}/{doc.id}', doc.to_dict())
+            candidates.setdefault(trip_ref.id, []).append((name, doc.reference, size))
+    for doc in db.collection_group('notes').stream():
+        # trips/{trip_id}/private_notes/{user_id}/notes/{note_id}
+        user_ref = doc.reference.parent.parent
+        if user_ref is None or user_ref.parent.id != 'private_notes':
+            continue
+        trip_ref = user_ref.parent.parent
+        size = estimate_doc_size(f'trips/{trip_ref.id}/private_notes/{user_ref.id}/notes/{doc.id}', doc.to_dict())
+        candidates.setdefault(trip_ref.id, []).append(('notes', doc.reference, size))
+
+    existing = _existing_trip_ids([tid for tid in candidates if tid])
+    orphans = [entry for tid, entries in candidates.items() if tid not in existing for entry in entries]
+    report['orphan_trips'] = sum(1 for tid in candidates if tid not in existing)
+    for name, _, size in orphans:
+        stats = report['collections'].setdefault(name, {'documents': 0, 'bytes': 0})
+        stats['documents'] += 1
+        stats['bytes'] += size
+    report['documents'] = len(orphans)
+    report['bytes'] = sum(size for _, _, size in orphans)
+
+    if not dry_run:
+        for chunk in _chunks(orphans, BATCH_LIMIT):
+            batch = db.batch()
+            for _, ref, _ in chunk:
+                batch.delete(ref)
+            batch.commit()
+    return report
+
+# Time every public function above per request (fs.<name> spans), except the
+# pure helpers and cache bookkeeping: they do no I/O and some run once per item
+instrument_module(globals(), 'fs', exclude=(
+    'initialize_firebase', 'invalidate_user_trips', 'invalidate_trip_lists', 'invalidate_trip_items',
+    'get_trips_cache_stats', 'get_acl_cache_stats', 'get_item_cache_stats',
+    'build_trip_summary', 'summary_category_counts', 'normalize_item_text', 'estimate_doc_size',
+))
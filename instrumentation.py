@@ -0,0 +1,409 @@
+import contextvars
+import functools
+import threading
+import random
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Request-scoped timing of Firestore, Gemini, Calendar and template rendering.
+# Each request gets a RequestTrace (a context variable, carried onto worker
+# pools through ContextThreadPoolExecutor / in_context); every span is also
+# added to process-wide totals for /metrics. Spans:
+#   fs.<function>  firebase_service calls (nested calls are listed too)
+#   fs             outermost firebase_service calls only
+#   firestore      Firestore RPCs, with documents read / written
+#   gemini         model calls (gemini.wait is time queued for a chat slot)
+#   calendar       Calendar API calls
+#   render         Jinja rendering, per template as render.<name>
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+# Fraction of requests run under the profiler (0 disables it)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+METRICS_PREFIX = 'travelpack'
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_trace = contextvars.ContextVar('request_trace', default=None)
+# firebase_service call depth, so 'fs' only counts outermost calls
+_fs_depth = contextvars.ContextVar('fs_depth', default=0)
+# Set while inside a Firestore RPC wrapper, so RPCs made by other RPC methods aren't counted twice
+_in_rpc = contextvars.ContextVar('in_firestore_rpc', default=False)
+
+
+class RequestTrace:
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans = {}  # name -> [calls, seconds, documents_read, documents_written]
+        self.profiler = None
+        self.long_lived = False
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, read=0, written=0):
+        with self._lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0, 0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] += read
+            span[3] += written
+
+    def snapshot(self):
+        with self._lock:
+            return {name: list(values) for name, values in self.spans.items()}
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class _Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}  # name -> [calls, seconds, read, written, errors]
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.durations = {}  # endpoint -> [bucket counts..., sum, count]
+        self.slow_requests = 0
+
+
+_metrics = _Metrics()
+
+
+def record(name, seconds, read=0, written=0, error=False):
+    """Adds one call of span `name` to the current request (if any) and the process totals."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, seconds, read, written)
+    with _metrics.lock:
+        span = _metrics.spans.setdefault(name, [0, 0.0, 0, 0, 0])
+        span[0] += 1
+        span[1] += seconds
+        span[2] += read
+        span[3] += written
+        span[4] += 1 if error else 0
+
+
+def timed(name):
+    """Decorator recording each call of the function as span `name`."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                record(name, time.perf_counter() - start, error=error)
+        return wrapper
+    return decorate
+
+
+def in_context(func):
+    """Binds func to the caller's context so work on another thread is attributed to this request."""
+    ctx = contextvars.copy_context()
+    return functools.wraps(func)(lambda *args, **kwargs: ctx.run(func, *args, **kwargs))
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks run in the submitting thread's context."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def instrument_module(namespace, prefix='fs', exclude=()):
+    """
+    Wraps every public function defined in the module whose globals() are
+    `namespace`, so internal calls between them are timed too.
+    """
+    module_name = namespace['__name__']
+    for name, func in list(namespace.items()):
+        if name.startswith('_') or name in exclude or not callable(func) or getattr(func, '__module__', None) != module_name:
+            continue
+        if isinstance(func, type) or hasattr(func, '__wrapped__'):
+            continue
+        namespace[name] = _fs_wrapper(func, f'{prefix}.{name}', prefix)
+
+
+def _fs_wrapper(func, span_name, outer_name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = _fs_depth.get()
+        token = _fs_depth.set(depth + 1)
+        start = time.perf_counter()
+        error = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            _fs_depth.reset(token)
+            seconds = time.perf_counter() - start
+            record(span_name, seconds, error=error)
+            if depth == 0:
+                record(outer_name, seconds, error=error)
+    return wrapper
+
+
+# Firestore RPCs
+
+def _rpc_wrapper(func, reads=None, writes=None):
+    """
+    reads: 'one' (a single snapshot) or 'iter' (count what the returned
+    iterator yields); writes: callable(args) -> number of writes, evaluated
+    before the call since commits clear their write list.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _in_rpc.get():
+            return func(*args, **kwargs)
+        written = 0
+        if writes:
+            try:
+                written = writes(args)
+            except Exception:
+                pass
+        token = _in_rpc.set(True)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            record('firestore', time.perf_counter() - start, error=True)
+            raise
+        finally:
+            _in_rpc.reset(token)
+        if reads == 'iter':
+            return _counting_iterator(result, start)
+        record('firestore', time.perf_counter() - start, read=1 if reads == 'one' else 0, written=written)
+        return result
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _counting_iterator(iterable, start):
+    # Streams do their RPCs while being iterated, so the guard is held for each step
+    iterator = iter(iterable)
+    count = 0
+    error = False
+    try:
+        while True:
+            token = _in_rpc.set(True)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                _in_rpc.reset(token)
+            count += 1
+            yield item
+    except Exception:
+        error = True
+        raise
+    finally:
+        # Firestore bills at least one read per query
+        record('firestore', time.perf_counter() - start, read=max(1, count), error=error)
+
+
+def _patch(cls, method, **kwargs):
+    func = getattr(cls, method, None)
+    if func is None or getattr(func, '_instrumented', False):
+        return
+    setattr(cls, method, _rpc_wrapper(func, **kwargs))
+
+
+def instrument_firestore(client):
+    """Counts RPCs, latency and documents for the client's Firestore implementation (once per class)."""
+    import memory_firestore
+    if isinstance(client, memory_firestore.Client):
+        _patch(memory_firestore.Client, '_commit', writes=lambda args: len(args[1]))
+        _patch(memory_firestore.Client, 'get_all', reads='iter')
+        _patch(memory_firestore.DocumentReference, 'get', reads='one')
+        _patch(memory_firestore.Query, 'stream', reads='iter')
+        _patch(memory_firestore.CollectionReference, 'list_documents', reads='iter')
+        return
+
+    from google.cloud.firestore_v1 import batch, client as client_module, collection, document, query, transaction
+    _patch(batch.WriteBatch, 'commit', writes=lambda args: len(args[0]._write_pbs))
+    _patch(transaction.Transaction, '_commit', writes=lambda args: len(args[0]._write_pbs))
+    _patch(transaction.Transaction, '_begin')
+    _patch(client_module.Client, 'get_all', reads='iter')
+    _patch(document.DocumentReference, 'get', reads='one')
+    _patch(query.Query, 'stream', reads='iter')
+    _patch(query.CollectionGroup, 'stream', reads='iter')
+    _patch(collection.CollectionReference, 'stream', reads='iter')
+    _patch(collection.CollectionReference, 'list_documents', reads='iter')
+
+
+# Profiling
+
+_profiler_factory = None
+
+
+def set_profiler(factory):
+    """
+    Replaces the sampling profiler. factory(trace) returns an object with
+    start() and stop(path) (e.g. a pyinstrument adapter); None restores cProfile.
+    """
+    global _profiler_factory
+    _profiler_factory = factory
+
+
+class _CProfileProfiler:
+    def __init__(self, trace):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self, path):
+        self.profile.disable()
+        self.profile.dump_stats(path + '.prof')
+
+
+# Request lifecycle (called from app.py)
+
+def start_request(endpoint):
+    trace = RequestTrace(endpoint)
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        try:
+            trace.profiler = (_profiler_factory or _CProfileProfiler)(trace)
+            trace.profiler.start()
+        except Exception as e:
+            print(f"Error starting profiler: {e}")
+            trace.profiler = None
+    _trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def long_lived():
+    """Marks the current request as a long-lived stream: counted, but kept out of the latency histogram and slow log."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.long_lived = True
+
+
+def _token(name):
+    return ''.join(ch if ch.isalnum() or ch in '._-' else '_' for ch in name)
+
+
+def server_timing(trace):
+    """Server-Timing header value: one metric per span plus the total."""
+    parts = []
+    for name, (calls, seconds, read, written) in sorted(trace.snapshot().items()):
+        desc = f'{calls} call{"s" if calls != 1 else ""}'
+        if read or written:
+            desc += f', {read} read, {written} written'
+        parts.append(f'{_token(name)};dur={seconds * 1000:.1f};desc="{desc}"')
+    parts.append(f'total;dur={trace.elapsed * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def finish_request(response, method):
+    """
+    Adds Server-Timing, updates request metrics and logs slow requests.
+    Streamed responses (chat SSE) are only complete once the body is sent, so
+    their metrics are recorded when the response closes; the header then only
+    covers the time up to the first byte.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return response
+    _trace.set(None)
+    response.headers['Server-Timing'] = server_timing(trace)
+    if response.is_streamed:
+        response.call_on_close(lambda: _complete(trace, method, response.status_code))
+    else:
+        _complete(trace, method, response.status_code)
+    return response
+
+
+def _complete(trace, method, status):
+    elapsed = trace.elapsed
+    endpoint = trace.endpoint or 'unknown'
+
+    if trace.profiler is not None:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            trace.profiler.stop(os.path.join(PROFILE_DIR, f'{endpoint}-{int(time.time() * 1000)}'))
+        except Exception as e:
+            print(f"Error saving profile: {e}")
+
+    with _metrics.lock:
+        key = (endpoint, method, status)
+        _metrics.requests[key] = _metrics.requests.get(key, 0) + 1
+        if trace.long_lived:
+            return
+        histogram = _metrics.durations.setdefault(endpoint, [0] * len(DURATION_BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if elapsed <= bound:
+                histogram[i] += 1
+        histogram[-2] += elapsed
+        histogram[-1] += 1
+        slow = elapsed * 1000 >= SLOW_REQUEST_MS
+        if slow:
+            _metrics.slow_requests += 1
+
+    if slow:
+        breakdown = ', '.join(f'{name}={seconds * 1000:.0f}ms/{calls}'
+                              for name, (calls, seconds, _, _) in sorted(trace.snapshot().items(),
+                                                                         key=lambda kv: -kv[1][1]))
+        print(f"Slow request: {method} {endpoint} {status} {elapsed * 1000:.0f}ms ({breakdown})")
+
+
+def abandon_request():
+    # Teardown without a response (e.g. an unhandled exception)
+    _trace.set(None)
+
+
+def render_metrics():
+    """Process-wide metrics in the Prometheus text exposition format."""
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    p = METRICS_PREFIX
+    lines = []
+    with _metrics.lock:
+        lines += [f'# HELP {p}_requests_total Requests by endpoint, method and status.',
+                  f'# TYPE {p}_requests_total counter']
+        for (endpoint, method, status), count in sorted(_metrics.requests.items(), key=str):
+            lines.append(f'{p}_requests_total{{endpoint="{label(endpoint)}",method="{method}",status="{status}"}} {count}')
+
+        lines += [f'# HELP {p}_request_duration_seconds Request latency by endpoint.',
+                  f'# TYPE {p}_request_duration_seconds histogram']
+        for endpoint, histogram in sorted(_metrics.durations.items()):
+            ep = label(endpoint)
+            for bound, count in zip(DURATION_BUCKETS, histogram):
+                lines.append(f'{p}_request_duration_seconds_bucket{{endpoint="{ep}",le="{bound}"}} {count}')
+            lines.append(f'{p}_request_duration_seconds_bucket{{endpoint="{ep}",le="+Inf"}} {histogram[-1]}')
+            lines.append(f'{p}_request_duration_seconds_sum{{endpoint="{ep}"}} {histogram[-2]:.6f}')
+            lines.append(f'{p}_request_duration_seconds_count{{endpoint="{ep}"}} {histogram[-1]}')
+
+        lines += [f'# HELP {p}_slow_requests_total Requests slower than SLOW_REQUEST_MS.',
+                  f'# TYPE {p}_slow_requests_total counter',
+                  f'{p}_slow_requests_total {_metrics.slow_requests}']
+
+        spans = sorted(_metrics.spans.items())
+        for metric, index, help_text in [('span_calls_total', 0, 'Calls per span.'),
+                                         ('span_seconds_total', 1, 'Time spent per span.'),
+                                         ('span_errors_total', 4, 'Failed calls per span.')]:
+            lines += [f'# HELP {p}_{metric} {help_text}', f'# TYPE {p}_{metric} counter']
+            for name, values in spans:
+                value = f'{values[index]:.6f}' if index == 1 else values[index]
+                lines.append(f'{p}_{metric}{{span="{label(name)}"}} {value}')
+
+        firestore = _metrics.spans.get('firestore', [0, 0.0, 0, 0, 0])
+        lines += [f'# HELP {p}_firestore_documents_read_total Firestore documents read.',
+                  f'# TYPE {p}_firestore_documents_read_total counter',
+                  f'{p}_firestore_documents_read_total {firestore[2]}',
+                  f'# HELP {p}_firestore_documents_written_total Firestore documents written.',
+                  f'# TYPE {p}_firestore_documents_written_total counter',
+                  f'{p}_firestore_documents_written_total {firestore[3]}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,373 @@
+import threading
+import sqlite3
+import random
+import json
+import time
+import uuid
+import os
+
+# Background jobs for slow or fire-and-forget work (Calendar inserts, cascade
+# deletes, ...). Requests enqueue and return; worker threads in each process
+# run due jobs with retries and exponential backoff. JOB_QUEUE_BACKEND is
+# 'sqlite' (default, survives restarts and is shared by the workers on one
+# host) or 'memory'. Where no worker outlives the request (serverless, where
+# the function is frozen after the response, or JOB_WORKERS=0) enqueue runs
+# the job's first attempt inline instead.
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'sqlite').lower()
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'jobs.sqlite3')
+JOB_WORKERS = 0 if os.getenv('VERCEL') else int(os.getenv('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', '2'))
+JOB_RETRY_MAX = float(os.getenv('JOB_RETRY_MAX', '300'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+# Running jobs older than this are assumed orphaned by a dead worker and requeued
+JOB_STALE_AFTER = float(os.getenv('JOB_STALE_AFTER', '600'))
+# Finished jobs are kept this long for status polling
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', str(24 * 3600)))
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+
+_handlers = {}
+# Jobs whose payload holds credentials (e.g. OAuth tokens)
+_private = set()
+
+
+def job(name, private=False):
+    """
+    Registers a handler: @job('calendar.reminder') def handler(payload): ...
+    payload is the JSON dict given to enqueue(). Handlers may update it in
+    place; it is saved with each retry so a handler can resume where it
+    stopped. Raising retries the job with backoff. private jobs carry
+    credentials, so they are never written to disk: they stay in the
+    enqueuing process's memory queue (and are lost if it restarts).
+    """
+    def register(func):
+        _handlers[name] = func
+        if private:
+            _private.add(name)
+        return func
+    return register
+
+
+class MemoryQueue:
+    """Jobs live in this process only and are lost on restart."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, row):
+        with self._lock:
+            self._jobs[row['id']] = dict(row)
+
+    def claim(self, now):
+        with self._lock:
+            due = [j for j in self._jobs.values() if j['status'] == QUEUED and j['run_at'] <= now]
+            if not due:
+                return None
+            row = min(due, key=lambda j: j['run_at'])
+            row.update(status=RUNNING, started_at=now, updated_at=now)
+            return dict(row)
+
+    def save(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._jobs.get(job_id)
+            return dict(row) if row else None
+
+    def requeue_stale(self, cutoff, now):
+        with self._lock:
+            for row in self._jobs.values():
+                if row['status'] == RUNNING and row['started_at'] < cutoff:
+                    row.update(status=QUEUED, run_at=now, updated_at=now)
+
+    def purge(self, cutoff):
+        with self._lock:
+            for job_id in [i for i, j in self._jobs.items()
+                           if j['status'] in (SUCCEEDED, FAILED) and j['updated_at'] < cutoff]:
+                del self._jobs[job_id]
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for row in self._jobs.values():
+                counts[row['status']] = counts.get(row['status'], 0) + 1
+            return counts
+
+
+class SQLiteQueue:
+    """On-disk queue; claiming is a single UPDATE so workers in several processes never share a job."""
+
+    _COLUMNS = ('id', 'name', 'payload', 'status', 'attempts', 'max_attempts', 'run_at',
+                'created_at', 'updated_at', 'started_at', 'error', 'result', 'owner')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, name TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, '
+                'attempts INTEGER NOT NULL, max_attempts INTEGER NOT NULL, run_at REAL NOT NULL, '
+                'created_at REAL NOT NULL, updated_at REAL NOT NULL, started_at REAL, '
+                'error TEXT, result TEXT, owner TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _row(self, values):
+        row = dict(zip(self._COLUMNS, values))
+        row['payload'] = json.loads(row['payload'])
+        row['result'] = json.loads(row['result']) if row['result'] is not None else None
+        return row
+
+    def add(self, row):
+        values = dict(row, payload=json.dumps(row['payload']), result=None)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                [values.get(c) for c in self._COLUMNS]
+            )
+
+    def claim(self, now):
+        token = uuid.uuid4().hex
+        with self._lock, self._connect() as conn:
+            # Reuse the error column as a claim marker until the job finishes
+            cur = conn.execute(
+                'UPDATE jobs SET status = ?, started_at = ?, updated_at = ?, error = ? WHERE id = ('
+                'SELECT id FROM jobs WHERE status = ? AND run_at <= ? ORDER BY run_at LIMIT 1)',
+                (RUNNING, now, now, token, QUEUED, now)
+            )
+            if cur.rowcount == 0:
+                return None
+            values = conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE status = ? AND error = ?", (RUNNING, token)
+            ).fetchone()
+        if values is None:
+            return None
+        row = self._row(values)
+        row['error'] = None
+        return row
+
+    def save(self, job_id, **fields):
+        if 'payload' in fields:
+            fields['payload'] = json.dumps(fields['payload'])
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', list(fields.values()) + [job_id])
+
+    def get(self, job_id):
+        with self._lock, self._connect() as conn:
+            values = conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(values) if values else None
+
+    def requeue_stale(self, cutoff, now):
+        with self._lock, self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, run_at = ?, updated_at = ?, error = NULL '
+                         'WHERE status = ? AND started_at < ?', (QUEUED, now, now, RUNNING, cutoff))
+
+    def purge(self, cutoff):
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?', (SUCCEEDED, FAILED, cutoff))
+
+    def counts(self):
+        with self._lock, self._connect() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+def _make_queue():
+    if JOB_QUEUE_BACKEND == 'sqlite':
+        try:
+            return SQLiteQueue(JOB_QUEUE_PATH)
+        except Exception as e:
+            print(f"Error opening job queue at {JOB_QUEUE_PATH}, using memory: {e}")
+    return MemoryQueue()
+
+
+_queue = _make_queue()
+_local_queue = _queue if isinstance(_queue, MemoryQueue) else MemoryQueue()
+
+
+def _queue_for(name):
+    return _local_queue if name in _private else _queue
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'enqueued': 0, 'started': 0, 'succeeded': 0, 'retried': 0, 'failed': 0, 'run_seconds': 0.0}
+
+
+def _count(key, delta=1):
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def retry_delay(attempts):
+    # Exponential backoff with jitter: ~2s, 4s, 8s, ... capped at JOB_RETRY_MAX
+    delay = min(JOB_RETRY_BASE * (2 ** max(attempts - 1, 0)), JOB_RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _run(row, retry=True):
+    handler = _handlers.get(row['name'])
+    queue = _queue_for(row['name'])
+    payload = row['payload']
+    attempts = row['attempts'] + 1
+    started = time.monotonic()
+    _count('started')
+    try:
+        if handler is None:
+            raise LookupError(f"no handler registered for job '{row['name']}'")
+        result = handler(payload)
+    except Exception as e:
+        now = time.time()
+        error = f"{type(e).__name__}: {e}"
+        if retry and attempts < row['max_attempts'] and handler is not None:
+            _count('retried')
+            queue.save(row['id'], status=QUEUED, attempts=attempts, error=error, payload=payload,
+                       run_at=now + retry_delay(attempts), updated_at=now)
+        else:
+            _count('failed')
+            print(f"Error running job {row['name']} ({row['id']}): {error}")
+            # Credentials aren't kept past the job's last attempt
+            if row['name'] in _private:
+                payload = {}
+            queue.save(row['id'], status=FAILED, attempts=attempts, error=error, payload=payload, updated_at=now)
+    else:
+        _count('succeeded')
+        if row['name'] in _private:
+            payload = {}
+        queue.save(row['id'], status=SUCCEEDED, attempts=attempts, error=None, payload=payload,
+                   result=result, updated_at=time.time())
+    finally:
+        _count('run_seconds', time.monotonic() - started)
+
+
+def _claim():
+    now = time.time()
+    row = _local_queue.claim(now)
+    if row is None and _queue is not _local_queue:
+        row = _queue.claim(now)
+    return row
+
+
+def _worker_loop():
+    while True:
+        try:
+            row = _claim()
+        except Exception as e:
+            print(f"Error claiming job: {e}")
+            row = None
+        if row is None:
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        _run(row)
+
+
+def _maintenance_loop():
+    while True:
+        now = time.time()
+        for queue in {_queue, _local_queue}:
+            try:
+                queue.requeue_stale(now - JOB_STALE_AFTER, now)
+                queue.purge(now - JOB_RETENTION)
+            except Exception as e:
+                print(f"Error maintaining job queue: {e}")
+        time.sleep(max(JOB_STALE_AFTER / 4, JOB_POLL_INTERVAL))
+
+
+def start_workers():
+    """Starts this process's worker threads (once). Called lazily by enqueue()."""
+    if _workers:
+        return
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(JOB_WORKERS):
+            thread = threading.Thread(target=_worker_loop, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            _workers.append(thread)
+        thread = threading.Thread(target=_maintenance_loop, name='job-maintenance', daemon=True)
+        thread.start()
+        _workers.append(thread)
+
+
+def enqueue(name, payload=None, owner=None, max_attempts=None, delay=0):
+    """
+    Queues a job and returns its id right away. owner limits who may poll its
+    status. Without background workers (JOB_WORKERS=0, serverless) the job
+    runs once, inline, before this returns; get_job() then has its outcome.
+    """
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    row = {
+        'id': job_id,
+        'name': name,
+        'payload': payload or {},
+        'status': QUEUED,
+        'attempts': 0,
+        'max_attempts': max_attempts or JOB_MAX_ATTEMPTS,
+        'run_at': now + delay,
+        'created_at': now,
+        'updated_at': now,
+        'started_at': None,
+        'error': None,
+        'owner': owner,
+    }
+    queue = _queue_for(name)
+    _count('enqueued')
+    if JOB_WORKERS <= 0 and not delay:
+        queue.add(dict(row, status=RUNNING, started_at=now))
+        _run(row, retry=False)
+        return job_id
+    queue.add(row)
+    start_workers()
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id, owner=None):
+    """Public view of a job (no payload), or None if unknown or owned by someone else."""
+    try:
+        row = _local_queue.get(job_id) or _queue.get(job_id)
+    except Exception as e:
+        print(f"Error reading job: {e}")
+        return None
+    if row is None or (owner is not None and row.get('owner') not in (None, owner)):
+        return None
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'max_attempts': row['max_attempts'],
+        'error': row['error'] if row['status'] != RUNNING else None,
+        'result': row.get('result'),
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+    }
+
+
+def get_job_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    finished = stats['succeeded'] + stats['failed'] + stats['retried']
+    stats['avg_run_seconds'] = (stats.pop('run_seconds') / finished) if finished else 0.0
+    stats['backend'] = 'sqlite' if isinstance(_queue, SQLiteQueue) else 'memory'
+    stats['workers'] = sum(1 for t in _workers if t.name.startswith('job-worker'))
+    try:
+        stats['queue'] = _queue.counts()
+    except Exception:
+        stats['queue'] = None
+    if _local_queue is not _queue:
+        stats['private_queue'] = _local_queue.counts()
+    return stats
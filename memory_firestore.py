@@ -0,0 +1,689 @@
+"""
+In-process stand-in for the part of the Firestore client API that
+firebase_service and chat_history use, so the app can run (and be
+benchmarked) without credentials. Enable with FIRESTORE_BACKEND=memory, or
+FIRESTORE_BACKEND=sqlite to keep the data in FIRESTORE_SQLITE_PATH between
+runs.
+
+It follows Firestore's semantics where the app relies on them: field-path
+updates, sentinels and transforms, query ordering across types (documents
+missing an order_by field are skipped), cursors, projections, 500-write
+batches, and optimistic transactions that raise Aborted on conflict so
+firestore.transactional retries. Every RPC the real client would make counts
+as one round trip and sleeps FIRESTORE_LATENCY_MS first; see stats().
+"""
+from google.cloud.firestore_v1 import transforms, DELETE_FIELD, SERVER_TIMESTAMP
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.api_core import exceptions
+from datetime import datetime, timezone
+import threading
+import sqlite3
+import pickle
+import copy
+import time
+import uuid
+import os
+
+MAX_BATCH_WRITES = 500
+
+# FieldPath.document_id(), as a parsed path
+_DOCUMENT_ID = ['__name__']
+
+
+# Storage
+
+class MemoryStore:
+    """Documents by collection path: {collection_path: {doc_id: (data, version)}}."""
+
+    def __init__(self):
+        self.collections = {}
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def get(self, coll_path, doc_id):
+        return self.collections.get(coll_path, {}).get(doc_id)
+
+    def apply(self, changes):
+        """changes: [(coll_path, doc_id, data or None)]; data None deletes."""
+        self.version += 1
+        for coll_path, doc_id, data in changes:
+            docs = self.collections.setdefault(coll_path, {})
+            if data is None:
+                docs.pop(doc_id, None)
+            else:
+                docs[doc_id] = (data, self.version)
+
+
+class SQLiteStore(MemoryStore):
+    """MemoryStore that also writes every commit through to SQLite and reloads it on start."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS documents ('
+                         'collection TEXT NOT NULL, id TEXT NOT NULL, data BLOB NOT NULL, '
+                         'PRIMARY KEY (collection, id))')
+            # Pickled so timestamps round-trip; the file is local development data only
+            for coll_path, doc_id, blob in conn.execute('SELECT collection, id, data FROM documents'):
+                self.collections.setdefault(coll_path, {})[doc_id] = (pickle.loads(blob), 0)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def apply(self, changes):
+        super().apply(changes)
+        with self._connect() as conn:
+            for coll_path, doc_id, data in changes:
+                if data is None:
+                    conn.execute('DELETE FROM documents WHERE collection = ? AND id = ?', (coll_path, doc_id))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)',
+                                 (coll_path, doc_id, pickle.dumps(data)))
+
+
+# Values
+
+def _type_rank(value):
+    # Firestore's cross-type ordering
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, DocumentReference):
+        return 6
+    if isinstance(value, (list, tuple)):
+        return 8
+    if isinstance(value, dict):
+        return 9
+    return 7
+
+
+def _sort_value(value):
+    rank = _type_rank(value)
+    if rank == 3 and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    if rank == 6:
+        value = value.path
+    if rank == 8:
+        value = tuple(_sort_value(v) for v in value)
+    if rank == 9:
+        value = tuple(sorted((k, _sort_value(v)) for k, v in value.items()))
+    return (rank, value) if rank else (0,)
+
+
+_MISSING = object()
+
+
+def _get_field(data, path):
+    for part in path:
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _resolve(old, value, now):
+    """Applies a sentinel / transform to the current value."""
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, transforms.Increment):
+        base = old if isinstance(old, (int, float)) and not isinstance(old, bool) else 0
+        return base + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        base = list(old) if isinstance(old, list) else []
+        for v in value.values:
+            if v not in base:
+                base.append(copy.deepcopy(v))
+        return base
+    if isinstance(value, transforms.ArrayRemove):
+        return [v for v in old if v not in value.values] if isinstance(old, list) else []
+    if isinstance(value, dict):
+        return {k: _resolve(None, v, now) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _merge(target, data, now):
+    # set(merge=True): maps merge recursively, everything else replaces
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value, now)
+        else:
+            target[key] = _resolve(target.get(key), value, now)
+
+
+_TRANSFORMS = (transforms.Increment, transforms.ArrayUnion, transforms.ArrayRemove)
+
+
+def _transform_results(kind, data, new):
+    """
+    What Firestore reports for a write's field transforms: the transformed
+    fields' new values, in field path order.
+    """
+    if kind not in ('update', 'set') or not data:
+        return []
+    paths = []
+    for key, value in data.items():
+        if value is SERVER_TIMESTAMP or isinstance(value, _TRANSFORMS):
+            paths.append(parse_field_path(key) if kind == 'update' else [key])
+    return [copy.deepcopy(_get_field(new, path)) for path in sorted(paths)]
+
+
+def _update(target, data, now):
+    # update(): keys are field paths ("a.b", "a.`c.d`")
+    for key, value in data.items():
+        path = parse_field_path(key)
+        parent = target
+        for part in path[:-1]:
+            if not isinstance(parent.get(part), dict):
+                parent[part] = {}
+            parent = parent[part]
+        if value is DELETE_FIELD:
+            parent.pop(path[-1], None)
+        else:
+            parent[path[-1]] = _resolve(parent.get(path[-1]), value, now)
+
+
+# Client
+
+class Client:
+    def __init__(self, store=None, latency=0.0):
+        self._store = store or MemoryStore()
+        self.latency = latency
+        self._watches = []
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @classmethod
+    def from_env(cls, backend='memory'):
+        latency = float(os.getenv('FIRESTORE_LATENCY_MS', '0')) / 1000
+        if backend == 'sqlite':
+            return cls(SQLiteStore(os.getenv('FIRESTORE_SQLITE_PATH', 'firestore.sqlite3')), latency)
+        return cls(MemoryStore(), latency)
+
+    # Accounting
+
+    def _round_trip(self, kind, documents_read=0, documents_written=0):
+        with self._stats_lock:
+            self._stats['round_trips'] += 1
+            self._stats['calls'][kind] = self._stats['calls'].get(kind, 0) + 1
+            self._stats['documents_read'] += documents_read
+            self._stats['documents_written'] += documents_written
+        if self.latency:
+            time.sleep(self.latency)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['calls'] = dict(stats['calls'])
+            return stats
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {'round_trips': 0, 'documents_read': 0, 'documents_written': 0, 'calls': {}}
+
+    # API
+
+    def collection(self, *path):
+        return CollectionReference(self, '/'.join(path))
+
+    def collection_group(self, collection_id):
+        return Query(self, collection_id, all_descendants=True)
+
+    def document(self, *path):
+        parts = '/'.join(path).split('/')
+        return DocumentReference(self, '/'.join(parts[:-1]), parts[-1])
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return Transaction(self, max_attempts, read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        with self._store.lock:
+            snapshots = [ref._snapshot(transaction) for ref in references]
+        self._round_trip('get_all', documents_read=max(1, len(snapshots)))
+        return iter(snapshots)
+
+    # Internals
+
+    def _commit(self, writes, read_versions=None):
+        if len(writes) > MAX_BATCH_WRITES:
+            raise exceptions.InvalidArgument(f'maximum {MAX_BATCH_WRITES} writes allowed per request')
+        now = datetime.now(timezone.utc)
+        with self._store.lock:
+            for (coll_path, doc_id), version in (read_versions or {}).items():
+                current = self._store.get(coll_path, doc_id)
+                if (current[1] if current else 0) != version:
+                    raise exceptions.Aborted('Transaction lock timeout (document changed concurrently)')
+            pending = {}
+            changes = []
+            results = []
+            for kind, ref, data, merge in writes:
+                key = (ref._coll_path, ref.id)
+                if key in pending:
+                    current = pending[key]
+                else:
+                    stored = self._store.get(*key)
+                    current = copy.deepcopy(stored[0]) if stored else None
+                if kind == 'delete':
+                    new = None
+                elif kind == 'update':
+                    if current is None:
+                        raise exceptions.NotFound(f'No document to update: {ref.path}')
+                    new = current
+                    _update(new, data, now)
+                elif kind == 'create' and current is not None:
+                    raise exceptions.Conflict(f'Document already exists: {ref.path}')
+                elif merge and current is not None:
+                    new = current
+                    _merge(new, data, now)
+                else:
+                    new = {}
+                    _merge(new, data, now)
+                pending[key] = new
+                changes.append((key[0], key[1], new))
+                results.append(WriteResult(now, _transform_results(kind, data, new)))
+            self._store.apply(changes)
+        self._round_trip('commit', documents_written=len(writes))
+        self._notify({coll_path for coll_path, _, _ in changes})
+        return results
+
+    def _notify(self, coll_paths):
+        for watch in list(self._watches):
+            if any(watch.query._matches_collection(path) for path in coll_paths):
+                watch._fire()
+
+
+class WriteResult:
+    def __init__(self, update_time, transform_results=()):
+        self.update_time = update_time
+        # Plain values here; the real client returns Value messages
+        self.transform_results = list(transform_results)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, version=0, read_time=None):
+        self.reference = reference
+        self._data = data
+        self._version = version
+        self.exists = data is not None
+        self.read_time = read_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = _get_field(self._data or {}, parse_field_path(field_path))
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, client, coll_path, doc_id):
+        self._client = client
+        self._coll_path = coll_path
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f'{self._coll_path}/{self.id}'
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self._coll_path)
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, f'{self.path}/{collection_id}')
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def _snapshot(self, transaction=None):
+        stored = self._client._store.get(self._coll_path, self.id)
+        if transaction is not None:
+            transaction._read((self._coll_path, self.id), stored[1] if stored else 0)
+        if stored is None:
+            return DocumentSnapshot(self, None)
+        return DocumentSnapshot(self, copy.deepcopy(stored[0]), stored[1], datetime.now(timezone.utc))
+
+    def get(self, field_paths=None, transaction=None):
+        with self._client._store.lock:
+            snapshot = self._snapshot(transaction)
+        self._client._round_trip('get', documents_read=1)
+        return snapshot
+
+    def set(self, document_data, merge=False):
+        return self._client._commit([('set', self, document_data, merge)])[0]
+
+    def create(self, document_data):
+        return self._client._commit([('create', self, document_data, False)])[0]
+
+    def update(self, field_updates):
+        return self._client._commit([('update', self, field_updates, False)])[0]
+
+    def delete(self):
+        return self._client._commit([('delete', self, None, False)])[0]
+
+    # Watch target: re-read after every commit to this document's collection
+    def _matches_collection(self, coll_path):
+        return coll_path == self._coll_path
+
+    def _run(self):
+        with self._client._store.lock:
+            return [self._snapshot()]
+
+    def on_snapshot(self, callback):
+        watch = Watch(self, callback)
+        self._client._watches.append(watch)
+        watch._fire()
+        return watch
+
+
+_OPERATORS = {
+    '==': lambda a, b: a is not _MISSING and _sort_value(a) == _sort_value(b),
+    '!=': lambda a, b: a is not _MISSING and a is not None and _sort_value(a) != _sort_value(b),
+    '<': lambda a, b: a is not _MISSING and _type_rank(a) == _type_rank(b) and _sort_value(a) < _sort_value(b),
+    '<=': lambda a, b: a is not _MISSING and _type_rank(a) == _type_rank(b) and _sort_value(a) <= _sort_value(b),
+    '>': lambda a, b: a is not _MISSING and _type_rank(a) == _type_rank(b) and _sort_value(a) > _sort_value(b),
+    '>=': lambda a, b: a is not _MISSING and _type_rank(a) == _type_rank(b) and _sort_value(a) >= _sort_value(b),
+    'in': lambda a, b: a is not _MISSING and any(_sort_value(a) == _sort_value(v) for v in b),
+    'not-in': lambda a, b: a is not _MISSING and a is not None and all(_sort_value(a) != _sort_value(v) for v in b),
+    'array_contains': lambda a, b: isinstance(a, list) and any(_sort_value(v) == _sort_value(b) for v in a),
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(_sort_value(v) == _sort_value(x) for v in a for x in b),
+}
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, client, path, all_descendants=False, filters=(), orders=(), limit=None,
+                 cursor=None, projection=None):
+        self._client = client
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        args = dict(path=self._path, all_descendants=self._all_descendants, filters=self._filters,
+                    orders=self._orders, limit=self._limit, cursor=self._cursor, projection=self._projection)
+        args.update(changes)
+        return Query(self._client, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f'Operator {op_string!r} is not supported')
+        return self._copy(filters=self._filters + ((parse_field_path(field_path), op_string, value),))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((parse_field_path(field_path), direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        snapshot = document_fields_or_snapshot
+        if isinstance(snapshot, DocumentSnapshot) and not snapshot.exists:
+            raise ValueError("Can't use a nonexistent document as a query cursor")
+        return self._copy(cursor=snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=[parse_field_path(f) for f in field_paths])
+
+    def _matches_collection(self, coll_path):
+        if self._all_descendants:
+            return coll_path.rsplit('/', 1)[-1] == self._path
+        return coll_path == self._path
+
+    def _sort_key(self, coll_path, doc_id, data):
+        key = []
+        name = f'{coll_path}/{doc_id}'
+        for path, direction in self._orders:
+            value = name if path == _DOCUMENT_ID else _sort_value(_get_field(data, path))
+            key.append(_Reversed(value) if direction == Query.DESCENDING else value)
+        # Ties break on the document name, in the direction of the last ordering
+        last_desc = bool(self._orders) and self._orders[-1][1] == Query.DESCENDING
+        key.append(_Reversed(name) if last_desc else name)
+        return key
+
+    def _run(self, transaction=None):
+        store = self._client._store
+        with store.lock:
+            matched = []
+            for coll_path, docs in store.collections.items():
+                if not self._matches_collection(coll_path):
+                    continue
+                for doc_id, (data, version) in docs.items():
+                    if any(not _OPERATORS[op](_get_field(data, path), value) for path, op, value in self._filters):
+                        continue
+                    # Documents without an order_by field are not in that index
+                    if any(path != _DOCUMENT_ID and _get_field(data, path) is _MISSING for path, _ in self._orders):
+                        continue
+                    matched.append((self._sort_key(coll_path, doc_id, data), coll_path, doc_id, data, version))
+            matched.sort(key=lambda m: m[0])
+            if self._cursor is not None:
+                cursor_key = self._cursor_key()
+                matched = [m for m in matched if m[0][:len(cursor_key)] > cursor_key]
+            if self._limit is not None:
+                matched = matched[:self._limit]
+            now = datetime.now(timezone.utc)
+            snapshots = []
+            for _, coll_path, doc_id, data, version in matched:
+                if transaction is not None:
+                    transaction._read((coll_path, doc_id), version)
+                if self._projection is not None:
+                    projected = {}
+                    for path in self._projection:
+                        value = _get_field(data, path)
+                        if value is not _MISSING:
+                            target = projected
+                            for part in path[:-1]:
+                                target = target.setdefault(part, {})
+                            target[path[-1]] = value
+                    data = projected
+                snapshots.append(DocumentSnapshot(DocumentReference(self._client, coll_path, doc_id),
+                                                  copy.deepcopy(data), version, now))
+        return snapshots
+
+    def _cursor_key(self):
+        if isinstance(self._cursor, DocumentSnapshot):
+            ref = self._cursor.reference
+            return self._sort_key(ref._coll_path, ref.id, self._cursor._data)
+        # Field values, in order_by order; the document name may be a reference or an id
+        key = []
+        for path, direction in self._orders[:len(self._cursor)]:
+            field = '.'.join(path)
+            value = self._cursor[field] if field in self._cursor else _get_field(self._cursor, path)
+            if path == _DOCUMENT_ID:
+                value = value.path if isinstance(value, DocumentReference) else f'{self._path}/{value}'
+            else:
+                value = _sort_value(value)
+            key.append(_Reversed(value) if direction == Query.DESCENDING else value)
+        return key
+
+    def stream(self, transaction=None):
+        snapshots = self._run(transaction)
+        # Firestore bills at least one read per query
+        self._client._round_trip('query', documents_read=max(1, len(snapshots)))
+        return iter(snapshots)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction=transaction))
+
+    def on_snapshot(self, callback):
+        watch = Watch(self, callback)
+        self._client._watches.append(watch)
+        watch._fire()
+        return watch
+
+
+class _Reversed:
+    """Inverts comparisons for DESCENDING orderings."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class Watch:
+    """Re-runs the query (or re-reads the document) and calls back after every commit that touches its collection."""
+
+    def __init__(self, query, callback):
+        self.query = query
+        self.callback = callback
+
+    def _fire(self):
+        try:
+            self.callback(self.query._run(), [], datetime.now(timezone.utc))
+        except Exception as e:
+            print(f"Error in snapshot listener: {e}")
+
+    def unsubscribe(self):
+        if self in self.query._client._watches:
+            self.query._client._watches.remove(self)
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        parts = self._path.split('/')
+        if len(parts) < 3:
+            return None
+        return DocumentReference(self._client, '/'.join(parts[:-2]), parts[-2])
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self._path, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        result = ref.create(document_data)
+        return result.update_time, ref
+
+    def list_documents(self, page_size=None):
+        """Like Firestore, includes "missing" documents that only have subcollections."""
+        store = self._client._store
+        with store.lock:
+            ids = set(store.collections.get(self._path, {}))
+            prefix = self._path + '/'
+            for coll_path, docs in store.collections.items():
+                if coll_path.startswith(prefix) and docs:
+                    ids.add(coll_path[len(prefix):].split('/', 1)[0])
+        self._client._round_trip('list_documents', documents_read=max(1, len(ids)))
+        return [self.document(doc_id) for doc_id in sorted(ids)]
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, False))
+
+    def update(self, reference, field_updates):
+        self._writes.append(('update', reference, field_updates, False))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+    def __len__(self):
+        return len(self._writes)
+
+
+class Transaction(WriteBatch):
+    """
+    Optimistic: records the version of everything read and aborts the commit
+    if any of it changed. Drives firestore.transactional through the same
+    private hooks as the real Transaction.
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._read_versions = {}
+
+    def _read(self, key, version):
+        self._read_versions.setdefault(key, version)
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+        self._client._round_trip('begin_transaction')
+
+    def _rollback(self):
+        if self._id is not None:
+            self._client._round_trip('rollback')
+        self._clean_up()
+
+    def _commit(self):
+        writes, read_versions = self._writes, self._read_versions
+        try:
+            return self._client._commit(writes, read_versions)
+        finally:
+            self._clean_up()
+
+    def commit(self):
+        return self._commit()
+
+    def get_all(self, references):
+        return self._client.get_all(references, transaction=self)
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return self._client.get_all([ref_or_query], transaction=self)
+        return ref_or_query.stream(transaction=self)
@@ -0,0 +1,24 @@
+"""
+Moves private notes stored the old way (a 'notes' array or a single 'content'
+field on trips/{trip_id}/private_notes/{user_id}) into the per-note
+subcollection. Notes are also migrated lazily on first access, so running
+this is optional; it is safe to run more than once.
+
+    python migrate_private_notes.py
+"""
+from dotenv import load_dotenv
+import firebase_service
+
+
+def main():
+    load_dotenv()
+    firebase_service.initialize_firebase()
+    if not firebase_service.db:
+        raise SystemExit('Firestore is not configured.')
+
+    report = firebase_service.migrate_private_notes()
+    print(f"Migrated {report['notes']} notes for {report['users']} users")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import threading
+from cache import TTLCache
+
+# Rendered category sections of trip_detail.html, keyed by (trip_id,
+# filter_user). Each entry remembers the trip version it was rendered from
+# (see firebase_service: every mutator bumps trips/{id}.version), so a view
+# of an unchanged trip reuses it without reading the items. Writes made by
+# this worker also drop the trip's entries right away.
+_fragments = TTLCache(maxsize=int(os.getenv('FRAGMENT_CACHE_SIZE', '512')),
+                      ttl=float(os.getenv('FRAGMENT_CACHE_TTL', '600')))
+
+
+def get_fragment(trip_id, filter_user=None, version=None):
+    """The cached fragment dict, or None. With version, only if it was rendered from that version."""
+    entry = _fragments.get((trip_id, filter_user or None))
+    if entry is None or (version is not None and entry['version'] != version):
+        return None
+    return entry
+
+
+def set_fragment(trip_id, filter_user, version, fragment):
+    key = (trip_id, filter_user or None)
+    current = _fragments.get(key)
+    # A slower render of an older version must not replace a newer one
+    if current is not None and current['version'] > version:
+        return
+    _fragments.set(key, dict(fragment, version=version))
+
+
+def invalidate_trip_fragments(trip_id):
+    return _fragments.discard_where(lambda key, _: key[0] == trip_id)
+
+
+def get_fragment_cache_stats():
+    return _fragments.stats()
+
+
+# ETags. Besides the data they describe, they include the templates' state so
+# a deploy with changed templates doesn't answer 304 for the old markup.
+_stamp = None
+_stamp_lock = threading.Lock()
+
+
+def _template_stamp():
+    global _stamp
+    if _stamp is None:
+        with _stamp_lock:
+            if _stamp is None:
+                folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+                mtimes = sorted((name, os.path.getmtime(os.path.join(folder, name)))
+                                for name in os.listdir(folder))
+                _stamp = os.getenv('RELEASE', '') + repr(mtimes)
+    return _stamp
+
+
+def make_etag(*parts):
+    """Strong ETag value (unquoted) for a page built from parts."""
+    digest = hashlib.sha1(_template_stamp().encode())
+    for part in parts:
+        digest.update(b'\0' + repr(part).encode())
+    return digest.hexdigest()[:32]
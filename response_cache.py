@@ -0,0 +1,191 @@
+from cache import TTLCache, SingleFlight
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import re
+import os
+
+# Cache for parsed chat responses, keyed on the trip, the normalized message,
+# the trip's item list and the chat history the prompt was built from (see
+# chat_cache_key). CHAT_CACHE_BACKEND is 'memory' (default), 'disk' or 'off'.
+CHAT_CACHE_BACKEND = os.getenv('CHAT_CACHE_BACKEND', 'memory').lower()
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', '3600'))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '2048'))
+CHAT_CACHE_PATH = os.getenv('CHAT_CACHE_PATH', 'chat_cache.sqlite3')
+
+
+class MemoryBackend:
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SQLiteBackend:
+    """Local on-disk backend so cached replies survive restarts and are shared by workers on one host."""
+
+    def __init__(self, path, maxsize, ttl):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT value, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires_at, now)
+            )
+            # Size cap: drop the least recently used rows beyond maxsize
+            conn.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.maxsize,)
+            )
+
+    def __len__(self):
+        with self._lock, self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+def _make_backend():
+    if CHAT_CACHE_BACKEND == 'off':
+        return None
+    if CHAT_CACHE_BACKEND == 'disk':
+        try:
+            return SQLiteBackend(CHAT_CACHE_PATH, CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+        except Exception as e:
+            print(f"Error opening chat cache at {CHAT_CACHE_PATH}, using memory: {e}")
+    return MemoryBackend(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+
+_backend = _make_backend()
+_flights = SingleFlight()
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+_SPACE_RE = re.compile(r'\s+')
+_TRAILING_PUNCT_RE = re.compile(r'[\s?!.]+$')
+
+
+def normalize_message(message):
+    # "What am I missing for the beach?" == "what am i  missing for the beach"
+    text = _SPACE_RE.sub(' ', (message or '').strip().lower())
+    return _TRAILING_PUNCT_RE.sub('', text)
+
+
+def chat_cache_key(trip_id, message, items, history):
+    # The reply depends on the asker's own conversation, so replies are never
+    # shared across trips or between different histories
+    item_keys = sorted(f"{i.get('text')}\x1f{i.get('category')}" for i in items)
+    digest = hashlib.sha256()
+    digest.update(str(trip_id).encode('utf-8'))
+    digest.update(b'\x1e')
+    digest.update(json.dumps([[t.get('role'), t.get('parts')] for t in history or []]).encode('utf-8'))
+    digest.update(b'\x1e')
+    digest.update(normalize_message(message).encode('utf-8'))
+    digest.update(b'\x1e')
+    digest.update('\x1e'.join(item_keys).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def get_cached_response(key):
+    if _backend is None:
+        return None
+    try:
+        value = _backend.get(key)
+    except Exception as e:
+        print(f"Error reading chat cache: {e}")
+        value = None
+    _count('hits' if value is not None else 'misses')
+    return value
+
+
+def store_response(key, value):
+    if _backend is None:
+        return
+    try:
+        _backend.set(key, value)
+    except Exception as e:
+        print(f"Error writing chat cache: {e}")
+
+
+def cached_chat_response(key, compute, timeout=None):
+    """
+    Returns the cached response for key, otherwise compute()'s result. Identical
+    requests that arrive while compute() is running wait for it instead of
+    making their own LLM call. Only successful results are cached.
+    """
+    cached = get_cached_response(key)
+    if cached is not None:
+        return cached
+
+    def compute_and_store():
+        result = compute()
+        store_response(key, result)
+        return result
+
+    return _flights.do(key, compute_and_store, timeout=timeout)
+
+
+def begin_flight(key):
+    """(is_leader, future) for callers that produce the response themselves, e.g. streaming."""
+    return _flights.begin(key)
+
+
+def finish_flight(key, result=None, error=None):
+    if error is None and result is not None:
+        store_response(key, result)
+    _flights.finish(key, result=result, error=error)
+
+
+def get_response_cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] / total) if total else 0.0
+    stats['shared_in_flight'] = _flights.shared
+    stats['backend'] = CHAT_CACHE_BACKEND if _backend is not None else 'off'
+    try:
+        stats['size'] = len(_backend) if _backend is not None else 0
+    except Exception:
+        stats['size'] = None
+    return stats
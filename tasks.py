@@ -0,0 +1,56 @@
+from jobs import job
+
+# Job handlers. Importing this module registers them; app.py does so at startup
+# so every process that enqueues can also run the jobs.
+
+
+# The OAuth token (which may hold a refresh_token) never reaches the queue's storage
+@job('calendar.trip_reminder', private=True)
+def trip_reminder(payload):
+    """
+    payload: token, trip_id, email, summary, date and optional countdown_days.
+    Builds the reminder (plus countdown reminders) on the first attempt and
+    keeps them in the payload with the links created so far, so a retry only
+    sends what is still missing.
+    """
+    from calendar_service import build_event, countdown_times, create_calendar_events
+
+    if 'events' not in payload:
+        from firebase_service import initialize_firebase, get_trip, get_unchecked_items
+        initialize_firebase()
+        trip = get_trip(payload['trip_id']) or {}
+        # Unchecked items come from the trip summary, not a scan of the items
+        unchecked_items = get_unchecked_items(payload['trip_id'], payload.get('email'), trip=trip)
+
+        summary = payload['summary']
+        description = f"Trip Reminder for {summary}\n\n"
+        if unchecked_items:
+            description += "Unchecked Items:\n" + "\n".join([f"- {item}" for item in unchecked_items])
+        else:
+            description += "All items packed!"
+        description += "\n\nAccess your list here: https://travel-pack-six.vercel.app"
+
+        events = [build_event(summary, description, payload['date'])]
+        for when, days_left in countdown_times(trip.get('start_date'), payload.get('countdown_days', 0), payload['date']):
+            events.append(build_event(f"{summary} - {days_left} day{'s' if days_left != 1 else ''} to go",
+                                      description, when))
+        payload['events'] = events
+        payload['links'] = [None] * len(events)
+
+    pending = [i for i, link in enumerate(payload['links']) if not link]
+    links = create_calendar_events(payload['token'], [payload['events'][i] for i in pending])
+    for i, link in zip(pending, links):
+        payload['links'][i] = link
+
+    created = sum(1 for link in payload['links'] if link)
+    if created < len(payload['links']):
+        raise RuntimeError(f"created {created} of {len(payload['links'])} calendar events")
+    return {'created': created, 'link': payload['links'][0]}
+
+
+@job('trip.delete_data')
+def trip_delete_data(payload):
+    """Cascade delete for a trip whose document is already gone. Re-running is harmless."""
+    from firebase_service import initialize_firebase, delete_trip_data
+    initialize_firebase()
+    return delete_trip_data(payload['trip_id'])
@@ -0,0 +1,235 @@
+import os
+import queue
+import threading
+import time
+
+# Live updates for people looking at the same trip. Each worker keeps one
+# channel per watched trip: a single Firestore listener pair (see
+# firebase_service.watch_trip) whose snapshots are diffed into item-level
+# events and fanned out to every connected viewer's queue. Events:
+#   {'type': 'item', 'change': 'added'|'modified'|'removed', 'item': {...}}
+#   {'type': 'version', 'version': n}  the trip document changed
+#   {'type': 'stale'}    the viewer missed changes (reconnected late, fell behind)
+#   {'type': 'deleted'}  the trip is gone
+
+# Off by default. Every open stream holds a worker thread (blocked waiting for
+# events) for up to SYNC_MAX_STREAM_SECONDS, so only turn it on for
+# long-running workers with threads to spare, and never on Vercel: serverless
+# functions are frozen after the response, so neither the stream nor the
+# Firestore listeners survive there.
+SYNC_ENABLED = os.getenv('TRIP_SYNC_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# Open streams allowed per worker, kept well below its thread count (the
+# Procfile runs 8) so viewers can't starve ordinary requests; extra ones get a 503
+SYNC_MAX_STREAMS = int(os.getenv('SYNC_MAX_STREAMS', '2'))
+SYNC_QUEUE_SIZE = int(os.getenv('SYNC_QUEUE_SIZE', '100'))
+SYNC_HEARTBEAT = float(os.getenv('SYNC_HEARTBEAT', '15'))
+# Streams are closed after this long (the page reconnects) so a worker thread
+# isn't held forever by one tab
+SYNC_MAX_STREAM_SECONDS = float(os.getenv('SYNC_MAX_STREAM_SECONDS', '300'))
+# Listeners outlive their last viewer by this much, so reloads reuse them
+SYNC_IDLE_CLOSE = float(os.getenv('SYNC_IDLE_CLOSE', '30'))
+SYNC_READY_TIMEOUT = 10
+
+_channels = {}
+_channels_lock = threading.Lock()
+_streams = 0  # open subscriptions, guarded by _channels_lock
+_stats = {'events': 0, 'delivered': 0, 'overflows': 0, 'listeners_started': 0, 'rejected': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def diff_items(old, new):
+    """Item events turning the {id: item} map old into new."""
+    events = []
+    for item_id, item in new.items():
+        previous = old.get(item_id)
+        if previous is None:
+            events.append({'type': 'item', 'change': 'added', 'item': item})
+        elif previous != item:
+            events.append({'type': 'item', 'change': 'modified', 'item': item})
+    for item_id, item in old.items():
+        if item_id not in new:
+            events.append({'type': 'item', 'change': 'removed', 'item': item})
+    return events
+
+
+class Subscription:
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=SYNC_QUEUE_SIZE)
+        self.overflowed = False
+        self.closed = False
+
+    def _offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            # A viewer this far behind gets one 'stale' and a fresh page instead
+            self.overflowed = True
+            return False
+
+    def events(self, since_version=None):
+        """
+        Yields events for this viewer, and None as a heartbeat every
+        SYNC_HEARTBEAT seconds. since_version is the trip version the page was
+        rendered from; if the trip has moved on, 'stale' comes first. Ends
+        after SYNC_MAX_STREAM_SECONDS or once the viewer can't catch up.
+        """
+        channel = self.channel
+        if not channel.ready.wait(SYNC_READY_TIMEOUT):
+            yield {'type': 'stale'}
+            return
+        if channel.version is None:
+            yield {'type': 'deleted'}
+            return
+        if since_version is not None and channel.version != since_version:
+            yield {'type': 'stale'}
+        deadline = time.monotonic() + SYNC_MAX_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            if self.overflowed:
+                yield {'type': 'stale'}
+                return
+            try:
+                event = self.queue.get(timeout=min(SYNC_HEARTBEAT, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                yield None
+                continue
+            _count('delivered')
+            yield event
+            if event['type'] == 'deleted':
+                return
+
+    def close(self):
+        global _streams
+        with _channels_lock:
+            if self.closed:
+                return
+            self.closed = True
+            _streams -= 1
+        self.channel.leave(self)
+
+
+class _Channel:
+    def __init__(self, trip_id):
+        self.trip_id = trip_id
+        self.subscribers = set()
+        self.items = None
+        self.version = None
+        self.ready = threading.Event()
+        self.stop = None
+        self.idle_timer = None
+        self._trip_seen = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        from firebase_service import watch_trip
+        self.stop = watch_trip(self.trip_id, self._on_items, self._on_trip)
+        if self.stop is not None:
+            _count('listeners_started')
+        return self.stop is not None
+
+    def _publish(self, events):
+        if not events:
+            return
+        _count('events', len(events))
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            for event in events:
+                if not subscriber._offer(event):
+                    _count('overflows')
+                    break
+
+    def _check_ready(self):
+        if self.items is not None and self._trip_seen:
+            self.ready.set()
+
+    def _on_items(self, items):
+        new = {item['id']: item for item in items}
+        with self._lock:
+            old, self.items = self.items, new
+        if old is None:
+            self._check_ready()
+            return
+        self._publish(diff_items(old, new))
+
+    def _on_trip(self, trip):
+        version = trip.get('version', 0) if trip else None
+        with self._lock:
+            changed = self._trip_seen and version != self.version
+            self.version = version
+            self._trip_seen = True
+        self._check_ready()
+        if changed:
+            self._publish([{'type': 'deleted'} if trip is None else {'type': 'version', 'version': version}])
+
+    def join(self):
+        subscription = Subscription(self)
+        with self._lock:
+            self.subscribers.add(subscription)
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+        return subscription
+
+    def leave(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+            if self.subscribers or self.idle_timer is not None:
+                return
+            self.idle_timer = threading.Timer(SYNC_IDLE_CLOSE, _close_if_idle, [self.trip_id, self])
+            self.idle_timer.daemon = True
+            self.idle_timer.start()
+
+    def close(self):
+        if self.stop is not None:
+            self.stop()
+            self.stop = None
+
+
+def _close_if_idle(trip_id, channel):
+    with _channels_lock:
+        with channel._lock:
+            if channel.subscribers or _channels.get(trip_id) is not channel:
+                return
+            channel.idle_timer = None
+        del _channels[trip_id]
+    channel.close()
+
+
+def subscribe(trip_id):
+    """
+    Joins the trip's channel, starting its listeners if needed. None if they
+    can't be started or this worker already has SYNC_MAX_STREAMS open.
+    """
+    global _streams
+    with _channels_lock:
+        if _streams >= SYNC_MAX_STREAMS:
+            _count('rejected')
+            return None
+        channel = _channels.get(trip_id)
+        if channel is None:
+            channel = _channels[trip_id] = _Channel(trip_id)
+            # Held under the lock so concurrent viewers share one listener pair;
+            # the memory backend calls back synchronously from here
+            if not channel.start():
+                del _channels[trip_id]
+                return None
+        _streams += 1
+        return channel.join()
+
+
+def get_sync_stats():
+    with _channels_lock:
+        channels = list(_channels.values())
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['streams'] = _streams
+    stats['channels'] = len(channels)
+    stats['viewers'] = sum(len(c.subscribers) for c in channels)
+    return stats